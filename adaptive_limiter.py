@@ -0,0 +1,84 @@
+import time
+import asyncio
+
+# Границы и стартовое значение числа одновременных запросов
+MIN_LIMIT = 1
+INITIAL_LIMIT = 10
+
+# Во сколько раз лимит падает на 429 или таймаут
+DECREASE_FACTOR = 0.5
+
+# Задержка считается здоровой, пока сглаженная не больше базовой в LATENCY_TOLERANCE раз
+LATENCY_TOLERANCE = 2.0
+LATENCY_SMOOTHING = 0.1
+
+# Базовая задержка медленно подтягивается вверх, чтобы один быстрый ответ не задал ее навсегда
+BASELINE_DRIFT = 0.001
+
+
+class AdaptiveLimiter:
+    """ AIMD-ограничитель одновременных запросов.
+
+    Пока задержка здоровая, лимит растет примерно на 1 за каждые limit ответов.
+    На 429 или таймаут лимит делится пополам, не чаще раза за сглаженную задержку,
+    чтобы одна волна отказов не обнулила его. Retry-After останавливает выдачу
+    новых разрешений для всех воркеров сразу.
+    """
+
+    def __init__(self, max_limit, initial=INITIAL_LIMIT, min_limit=MIN_LIMIT):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.active = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.latency = None
+        self.baseline = None
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.release()
+
+    async def acquire(self):
+        async with self.condition:
+            while True:
+                delay = self.paused_until - time.monotonic()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self.condition.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.active < int(self.limit):
+                    self.active += 1
+                    return
+                await self.condition.wait()
+
+    async def release(self):
+        async with self.condition:
+            self.active -= 1
+            # Лимит мог вырасти, пока запрос шел: будим всех, кому теперь хватает места
+            self.condition.notify(max(1, int(self.limit) - self.active))
+
+    def on_response(self, latency):
+        """ Ответ сервера без признаков перегрузки """
+        if self.latency is None:
+            self.latency = self.baseline = latency
+        else:
+            self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+            self.baseline = min(self.latency, self.baseline * (1 + BASELINE_DRIFT))
+        if self.latency <= self.baseline * LATENCY_TOLERANCE:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_overload(self, retry_after=None):
+        """ 429 или таймаут: режем лимит и, если сервер просит, ставим общую паузу """
+        now = time.monotonic()
+        if now - self.last_decrease >= (self.latency or 0):
+            self.limit = max(self.min_limit, self.limit * DECREASE_FACTOR)
+            self.last_decrease = now
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
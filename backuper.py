@@ -1,7 +1,10 @@
 import os
-import shutil
+import json
+import gzip
 import time
+import hashlib
 import logging
+import argparse
 
 
 logging.basicConfig(
@@ -17,8 +20,106 @@ BACKUP_DIR = "backups"
 # Интервал создания бэкапов (в секундах)
 BACKUP_INTERVAL = 300  # 5 минут
 
+# Бэкап хранится цепочками: полный снимок (base) и сжатые дельты (delta) только с байтами,
+# дописанными после прошлого бэкапа. Поколения и их контрольные суммы перечислены в манифесте
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+SEGMENT_PREFIX = "users_funpay_backup_"
+SEGMENT_SUFFIX = ".txt.gz"
+
+# После стольких дельт делается новый полный снимок, чтобы восстановление не разрасталось
+MAX_CHAIN_DELTAS = 288  # сутки при интервале 5 минут
+
+# Сколько последних цепочек (снимок со своими дельтами) хранить
+KEEP_CHAINS = 3
+
+# Сколько байт перед концом прошлого бэкапа сверять, чтобы убедиться, что файл только дописывался
+TAIL_CHECK_SIZE = 4096
+
+# Размер блока при копировании и уровень сжатия сегментов
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+GZIP_LEVEL = 6
+
+# Куда по умолчанию восстанавливается файл
+RESTORE_FILE = "users_funpay_restored.txt"
+
+
+def manifest_path():
+    return os.path.join(BACKUP_DIR, MANIFEST_FILE)
+
+
+def load_manifest():
+    try:
+        with open(manifest_path(), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {"version": MANIFEST_VERSION, "generations": []}
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"Неизвестная версия манифеста: {manifest.get('version')}")
+    return manifest
+
+
+def save_manifest(manifest):
+    """ Атомарно сохраняет манифест: сегменты, на которые он ссылается, уже на диске """
+    temp_path = manifest_path() + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, manifest_path())
+
+
+def complete_lines_end(src, size):
+    """ Смещение после последнего перевода строки до size: бэкап не режет строку пополам """
+    position = size
+    while position > 0:
+        start = max(0, position - COPY_CHUNK_SIZE)
+        src.seek(start)
+        newline = src.read(position - start).rfind(b"\n")
+        if newline != -1:
+            return start + newline + 1
+        position = start
+    return 0
+
+
+def tail_digest(src, end):
+    """ sha256 последних TAIL_CHECK_SIZE байт до end """
+    start = max(0, end - TAIL_CHECK_SIZE)
+    src.seek(start)
+    return hashlib.sha256(src.read(end - start)).hexdigest()
+
+
+def write_segment(src, start, end, path):
+    """ Сжимает байты [start, end) файла в path. Возвращает sha256 несжатых данных """
+    digest = hashlib.sha256()
+    temp_path = path + ".tmp"
+    src.seek(start)
+    remaining = end - start
+    with open(temp_path, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=GZIP_LEVEL) as out:
+            while remaining:
+                chunk = src.read(min(COPY_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError(f"Файл {ORIGINAL_FILE} укоротился во время бэкапа")
+                digest.update(chunk)
+                out.write(chunk)
+                remaining -= len(chunk)
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(temp_path, path)
+    return digest.hexdigest()
+
+
+def chain_start(generations, index):
+    """ Индекс снимка, с которого начинается цепочка поколения generations[index] """
+    while generations[index]["kind"] != "base":
+        index -= 1
+    return index
+
+
 def create_backup():
-    """ Создает резервную копию файла, если прошлый бэкап меньше оригинала """
+    """ Дописывает поколение бэкапа: дельту с новыми байтами или полный снимок,
+    если файл был перезаписан или цепочка стала слишком длинной """
     try:
         # Проверяем, существует ли оригинальный файл
         if not os.path.exists(ORIGINAL_FILE):
@@ -30,46 +131,166 @@ def create_backup():
             os.makedirs(BACKUP_DIR)
             logging.info(f"[ℹ] Создана директория для бэкапов: {BACKUP_DIR}")
 
-        # Получаем размер оригинального файла
-        original_size = os.path.getsize(ORIGINAL_FILE)
+        manifest = load_manifest()
+        generations = manifest["generations"]
+        last = generations[-1] if generations else None
 
-        # Получаем список существующих бэкапов
-        backups = sorted(
-            [f for f in os.listdir(BACKUP_DIR) if f.startswith("users_funpay_backup_")],
-            reverse=True,
-        )
+        with open(ORIGINAL_FILE, "rb") as src:
+            stat = os.fstat(src.fileno())
+            end = complete_lines_end(src, stat.st_size)
 
-        # Если есть предыдущий бэкап, проверяем его размер
-        if backups:
-            last_backup = os.path.join(BACKUP_DIR, backups[0])
-            last_backup_size = os.path.getsize(last_backup)
-
-            # Если размер последнего бэкапа больше или равен оригиналу, пропускаем создание нового
-            if last_backup_size >= original_size:
-                logging.info(
-                    f"[ℹ] Последний бэкап {last_backup} имеет размер {last_backup_size} байт, "
-                    f"что больше или равно оригиналу ({original_size} байт). Бэкап не создан."
-                )
+            # Файл только дописывался, если это тот же inode и байты перед концом прошлого бэкапа не изменились
+            appended = (
+                last is not None
+                and last["inode"] == stat.st_ino
+                and last["end"] <= end
+                and tail_digest(src, last["end"]) == last["tail_sha256"]
+            )
+            if appended and end == last["end"]:
+                logging.info(f"[ℹ] {ORIGINAL_FILE} не изменился с поколения {last['generation']}. Бэкап не создан.")
+                return
+            if not appended and end == 0:
+                logging.info(f"[ℹ] В {ORIGINAL_FILE} нет целых строк. Бэкап не создан.")
                 return
 
-            # Удаляем предыдущий бэкап перед созданием нового
-            os.remove(last_backup)
-            logging.info(f"[ℹ] Удален предыдущий бэкап: {last_backup}")
+            deltas = len(generations) - 1 - chain_start(generations, len(generations) - 1) if last else 0
+            kind = "delta" if appended and deltas < MAX_CHAIN_DELTAS else "base"
+            if last is not None and not appended:
+                logging.info(f"[ℹ] {ORIGINAL_FILE} перезаписан или заменен, делаю полный снимок.")
 
-        # Создаем новый бэкап
-        backup_name = f"users_funpay_backup_{time.strftime('%Y%m%d_%H%M%S')}.txt"
-        backup_path = os.path.join(BACKUP_DIR, backup_name)
-        shutil.copy2(ORIGINAL_FILE, backup_path)
+            start = last["end"] if kind == "delta" else 0
+            generation = last["generation"] + 1 if last else 1
+            name = f"{SEGMENT_PREFIX}{generation:06d}_{kind}{SEGMENT_SUFFIX}"
+            started = time.monotonic()
+            digest = write_segment(src, start, end, os.path.join(BACKUP_DIR, name))
+            generations.append({
+                "generation": generation,
+                "kind": kind,
+                "file": name,
+                "start": start,
+                "end": end,
+                "sha256": digest,
+                "tail_sha256": tail_digest(src, end),
+                "inode": stat.st_ino,
+                "created": time.time(),
+            })
 
+        save_manifest(manifest)
         logging.info(
-            f"[✔] Создан бэкап: {backup_path} (размер: {os.path.getsize(backup_path)} байт)"
+            f"[✔] Создано поколение {generation} ({kind}): {name}, байты {start}-{end} "
+            f"({end - start} байт, сжато {os.path.getsize(os.path.join(BACKUP_DIR, name))} байт) "
+            f"за {time.monotonic() - started:.2f} с"
         )
+        apply_retention(manifest)
 
     except Exception as e:
         logging.error(f"[⚠] Ошибка при создании бэкапа: {e}")
 
-def main():
-    """ Основная функция """
+
+def apply_retention(manifest):
+    """ Оставляет KEEP_CHAINS последних цепочек. Манифест сохраняется до удаления файлов,
+    поэтому он никогда не ссылается на удаленный сегмент """
+    generations = manifest["generations"]
+    bases = [index for index, entry in enumerate(generations) if entry["kind"] == "base"]
+    if len(bases) > KEEP_CHAINS:
+        cutoff = bases[-KEEP_CHAINS]
+        manifest["generations"] = generations[cutoff:]
+        save_manifest(manifest)
+        logging.info(
+            f"[ℹ] Удалены поколения {generations[0]['generation']}-{generations[cutoff - 1]['generation']} "
+            f"по политике хранения ({KEEP_CHAINS} цепочки)."
+        )
+
+    # Сегменты вне манифеста (после удаления или сбоя) и полные копии старого формата
+    known = {entry["file"] for entry in manifest["generations"]}
+    for name in os.listdir(BACKUP_DIR):
+        if not name.startswith(SEGMENT_PREFIX) or name in known:
+            continue
+        legacy = name.endswith(".txt")
+        if legacy and not manifest["generations"]:
+            continue
+        if legacy or name.endswith(SEGMENT_SUFFIX) or name.endswith(SEGMENT_SUFFIX + ".tmp"):
+            os.remove(os.path.join(BACKUP_DIR, name))
+            logging.info(f"[ℹ] Удален файл бэкапа: {name}")
+
+
+def find_generation(generations, generation):
+    if not generations:
+        raise ValueError("Бэкапов нет.")
+    if generation is None:
+        return len(generations) - 1
+    for index, entry in enumerate(generations):
+        if entry["generation"] == generation:
+            return index
+    raise ValueError(f"Поколение {generation} не найдено.")
+
+
+def read_segment(entry, out=None):
+    """ Распаковывает сегмент, сверяет длину и sha256; out — куда писать данные """
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with gzip.open(os.path.join(BACKUP_DIR, entry["file"]), "rb") as f:
+            while True:
+                chunk = f.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+                if out is not None:
+                    out.write(chunk)
+    except (OSError, EOFError) as e:
+        raise ValueError(f"Сегмент {entry['file']} не читается: {e}")
+    if size != entry["end"] - entry["start"] or digest.hexdigest() != entry["sha256"]:
+        raise ValueError(f"Сегмент {entry['file']} поврежден: не совпадает длина или контрольная сумма.")
+
+
+def restore(generation=None, output=RESTORE_FILE):
+    """ Собирает файл на момент поколения: снимок цепочки и все дельты до поколения включительно """
+    generations = load_manifest()["generations"]
+    index = find_generation(generations, generation)
+    temp_path = output + ".tmp"
+    try:
+        with open(temp_path, "wb") as out:
+            for entry in generations[chain_start(generations, index):index + 1]:
+                if out.tell() != entry["start"]:
+                    raise ValueError(f"Разрыв в цепочке перед поколением {entry['generation']}.")
+                read_segment(entry, out)
+            out.flush()
+            os.fsync(out.fileno())
+    except ValueError:
+        os.remove(temp_path)
+        raise
+    os.replace(temp_path, output)
+    return generations[index]
+
+
+def verify():
+    """ Проверяет все сегменты, возвращает список поврежденных поколений """
+    broken = []
+    for entry in load_manifest()["generations"]:
+        try:
+            read_segment(entry)
+        except ValueError as e:
+            broken.append(entry["generation"])
+            print(f"[⚠] Поколение {entry['generation']}: {e}")
+    return broken
+
+
+def print_generations():
+    generations = load_manifest()["generations"]
+    if not generations:
+        print("[ℹ] Бэкапов нет.")
+    for entry in generations:
+        created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["created"]))
+        print(
+            f"{entry['generation']:>6}  {entry['kind']:<5}  {created}  "
+            f"байты {entry['start']}-{entry['end']}  {entry['file']}"
+        )
+
+
+def run_backups():
+    """ Основной цикл """
     logging.info("[ℹ] Запуск скрипта для создания бэкапов.")
     while True:
         try:
@@ -80,7 +301,34 @@ def main():
             break
         except Exception as e:
             logging.error(f"[⚠] Ошибка в основном цикле: {e}")
-            time.sleep(60) 
+            time.sleep(60)
+
+def main():
+    """ Основная функция: без команды — цикл бэкапов, иначе list / restore / verify """
+    parser = argparse.ArgumentParser(description=f"Инкрементальные бэкапы {ORIGINAL_FILE}")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("list", help="показать поколения бэкапов")
+    restore_parser = commands.add_parser("restore", help="собрать файл на момент поколения")
+    restore_parser.add_argument("--generation", type=int, help="номер поколения, по умолчанию последнее")
+    restore_parser.add_argument("--output", default=RESTORE_FILE)
+    commands.add_parser("verify", help="проверить контрольные суммы всех сегментов")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "list":
+            print_generations()
+        elif args.command == "restore":
+            entry = restore(args.generation, args.output)
+            print(f"[✔] Поколение {entry['generation']} восстановлено в {args.output} ({entry['end']} байт).")
+        elif args.command == "verify":
+            broken = verify()
+            if broken:
+                raise SystemExit(f"[⚠] Повреждены поколения: {', '.join(map(str, broken))}")
+            print("[✔] Все сегменты целы.")
+        else:
+            run_backups()
+    except ValueError as e:
+        raise SystemExit(f"[⚠] {e}")
 
 if __name__ == "__main__":
     main()
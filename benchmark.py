@@ -0,0 +1,215 @@
+""" Бенчмарк путей запросов бота (/find, /check, /users) на синтетических базах.
+
+Запуск: python benchmark.py [--sizes 1000000 10000000 50000000] [--repeat 20]
+
+Бот импортируется как есть, поэтому в bot.py должен быть заполнен ADMIN_ID.
+Все файлы (users_funpay.txt, authorized_keys.db, exports/) создаются в --workdir.
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import statistics
+
+LATIN = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_"
+CYRILLIC = "абвгдеёжзийклмнопрстуфхцчшщъыьэюяАБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ"
+
+# Каждый SAMPLE_EVERY-й ник запоминается как запрос, который точно найдется
+SAMPLE_EVERY = 100_000
+
+
+def random_name(rng):
+    alphabet = CYRILLIC if rng.random() < 0.1 else LATIN
+    return "".join(rng.choices(alphabet, k=rng.randint(3, 16)))
+
+
+def generate_dataset(path, lines, seed=0):
+    """ Пишет файл в формате users_funpay.txt, возвращает выборку ников для запросов """
+    rng = random.Random(seed)
+    samples = []
+    with open(path + ".tmp", "w", encoding="utf-8-sig") as f:
+        batch = []
+        for user_id in range(1, lines + 1):
+            name = random_name(rng)
+            if user_id % SAMPLE_EVERY == 1:
+                samples.append(name)
+            batch.append(f"https://funpay.com/users/{user_id}/ - {name}\n")
+            if len(batch) >= 100_000:
+                f.write("".join(batch))
+                batch = []
+        f.write("".join(batch))
+    os.replace(path + ".tmp", path)
+    with open(path + ".samples", "w", encoding="utf-8") as f:
+        f.write("\n".join(samples))
+    return samples
+
+
+def load_or_generate(path, lines):
+    if os.path.exists(path) and os.path.exists(path + ".samples"):
+        with open(path + ".samples", "r", encoding="utf-8") as f:
+            return f.read().split("\n")
+    print(f"[ℹ] Генерирую {lines} строк в {path}...")
+    started = time.perf_counter()
+    samples = generate_dataset(path, lines)
+    print(f"[✔] Сгенерировано за {time.perf_counter() - started:.1f} с")
+    return samples
+
+
+class StubUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = "benchmark"
+
+
+class StubMessage:
+    def __init__(self, user_id):
+        self.from_user = StubUser(user_id)
+        self.text = ""
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+    async def reply_document(self, document, caption="", **kwargs):
+        self.replies.append(caption)
+
+
+class StubUpdate:
+    def __init__(self, user_id):
+        self.message = StubMessage(user_id)
+
+
+class StubContext:
+    def __init__(self, args):
+        self.args = args
+        self.bot = None
+
+
+def process_peak_rss_kb(pid):
+    """ Пиковый RSS живого процесса (VmHWM из /proc, только Linux) """
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+async def peak_rss_mb(bot):
+    """ Пиковый RSS бота и суммарный пиковый RSS процессов поиска (ru_maxrss в Linux — в КБ) """
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    shards_rss = sum(process_peak_rss_kb(pid) for pid in await bot.search_engine.pids()) / 1024
+    return self_rss, shards_rss
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+async def report(bot, name, latencies):
+    self_rss, shards_rss = await peak_rss_mb(bot)
+    print(
+        f"{name:<22} n={len(latencies):<4} "
+        f"p50={percentile(latencies, 0.5) * 1000:9.2f} мс  "
+        f"p90={percentile(latencies, 0.9) * 1000:9.2f} мс  "
+        f"p99={percentile(latencies, 0.99) * 1000:9.2f} мс  "
+        f"max={max(latencies) * 1000:9.2f} мс  "
+        f"mean={statistics.fmean(latencies) * 1000:9.2f} мс  "
+        f"rss={self_rss:.0f}+{shards_rss:.0f} МБ"
+    )
+
+
+async def measure(bot, handler, queries, repeat):
+    latencies = []
+    for i in range(repeat):
+        update = StubUpdate(bot.ADMIN_ID)
+        context = StubContext(queries[i % len(queries)] if queries else [])
+        started = time.perf_counter()
+        await handler(update, context)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+async def bench_dataset(bot, users_export, users_meta, lines, dataset_path, samples, repeat):
+    for path in ("users_funpay.txt", "users_funpay.txt.meta"):
+        if os.path.lexists(path):
+            os.remove(path)
+    os.symlink(dataset_path, "users_funpay.txt")
+
+    print(f"\n=== {lines} строк ({os.path.getsize(dataset_path) / 1024 / 1024:.0f} МБ) ===")
+
+    started = time.perf_counter()
+    await bot.search_engine.warmup()
+    await report(bot, "index_load", [time.perf_counter() - started])
+
+    strict_queries = [[name] for name in samples] + [["нет_такого_ника"]]
+    match_queries = [[name[:length]] for name in samples for length in (2, 3, 5) if len(name) >= length]
+
+    # Кэш результатов отключаем, чтобы мерить сам поиск
+    cache_size = bot.query_cache.max_size
+    bot.query_cache.max_size = 0
+    await report(bot, "find_strict", await measure(bot, bot.find_command, strict_queries, repeat))
+    await report(bot, "find_match", await measure(bot, bot.find_command, match_queries, repeat))
+    bot.query_cache.max_size = cache_size
+    await measure(bot, bot.find_command, match_queries[:1], 1)
+    await report(bot, "find_match_cached", await measure(bot, bot.find_command, match_queries[:1], repeat))
+
+    await report(bot, "check_cold", await measure(bot, bot.check_command, None, 1))
+    # В работе users_funpay.txt.meta ведет парсер, а бот только читает его (save=False)
+    users_meta.count_records("users_funpay.txt")
+    await report(bot, "check", await measure(bot, bot.check_command, None, repeat))
+
+    users_export.EXPORT_MAX_AGE = 0
+    bot.export_cache.current = None
+    await report(bot, "users_build", await measure(bot, bot.users_command, None, 1))
+    users_export.EXPORT_MAX_AGE = float("inf")
+    await report(bot, "users_cached", await measure(bot, bot.users_command, None, repeat))
+
+
+async def run(args):
+    try:
+        import bot
+    except SyntaxError:
+        sys.exit("[⚠] Заполните ADMIN_ID в bot.py перед запуском бенчмарка.")
+    import users_export
+    import users_meta
+
+    bot.logger.setLevel(logging.WARNING)
+
+    bot.STORAGE_MODE = "file"
+    if args.workers:
+        bot.search_engine.shutdown()
+        bot.search_engine = bot.SearchEngine("users_funpay.txt", args.workers)
+
+    try:
+        for lines in args.sizes:
+            dataset_path = os.path.abspath(f"users_{lines}.txt")
+            samples = load_or_generate(dataset_path, lines)
+            await bench_dataset(bot, users_export, users_meta, lines, dataset_path, samples, args.repeat)
+    finally:
+        bot.search_engine.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк запросов бота на синтетических базах")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000_000, 10_000_000, 50_000_000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=0, help="число процессов поиска (по умолчанию SEARCH_WORKERS)")
+    parser.add_argument("--workdir", default="bench_data")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.makedirs(args.workdir, exist_ok=True)
+    os.chdir(args.workdir)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
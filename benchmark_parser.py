@@ -0,0 +1,175 @@
+""" Сквозной бенчмарк parser.py на локальном стенде funpay_stub.py.
+
+Запуск: python benchmark_parser.py [--ids 20000] [--latency-ms 50] [--not-found-rate 0.1]
+        [--max-rps 1000] [--rate-limit-rate 0.0005] [--truncate-rate 0.01] [--shards 0]
+
+Стенд и парсер запускаются отдельными процессами, парсер — в чистом --workdir с --end-id.
+Печатает ID/с, процессорное время парсера на запрос и проверяет файлы результатов и ошибок:
+дубликаты, неверные ники, найденные 404 и ID, которые не попали ни в результаты, ни в ошибки.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import urllib.request
+from funpay_stub import STUB_PORT, expected_username, is_missing
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def wait_for_stub(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            return read_stats(port)
+        except OSError:
+            time.sleep(0.1)
+    sys.exit("[⚠] Стенд не запустился.")
+
+
+def read_stats(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats", timeout=5) as response:
+        return json.load(response)
+
+
+def read_output(path):
+    """ ID -> список ников из файла результатов """
+    found = {}
+    if not os.path.exists(path):
+        return found
+    with open(path, "r", encoding="utf-8-sig") as f:
+        for line in f:
+            url, _, name = line.rstrip("\n").partition(" - ")
+            try:
+                user_id = int(url.split("/")[4])
+            except (IndexError, ValueError):
+                continue
+            found.setdefault(user_id, []).append(name)
+    return found
+
+
+def read_error_ids(path):
+    error_ids = set()
+    if not os.path.exists(path):
+        return error_ids
+    with open(path, "r", encoding="utf-8-sig") as f:
+        for line in f:
+            fields = line.split("\t")
+            if len(fields) > 1 and fields[0] == "F":
+                error_ids.add(int(fields[1]))
+            elif len(fields) > 2 and fields[0] == "G":
+                error_ids.update(range(int(fields[1]), int(fields[2]) + 1))
+            elif len(fields) > 1 and fields[0] == "R":
+                error_ids.discard(int(fields[1]))
+    return error_ids
+
+
+def verify(workdir, last_id, not_found_rate, seed):
+    found = read_output(os.path.join(workdir, "users_funpay.txt"))
+    error_ids = read_error_ids(os.path.join(workdir, "errors_funpay.ledger"))
+
+    report = {"found": 0, "duplicates": 0, "wrong_name": 0, "found_missing": 0, "errors": 0, "lost": 0}
+    for user_id, names in found.items():
+        report["found"] += 1
+        if len(names) > 1:
+            report["duplicates"] += 1
+        if any(name != expected_username(user_id) for name in names):
+            report["wrong_name"] += 1
+        if is_missing(user_id, not_found_rate, seed):
+            report["found_missing"] += 1
+    for user_id in range(1, last_id + 1):
+        if user_id in found:
+            continue
+        if user_id in error_ids:
+            report["errors"] += 1
+        else:
+            report["lost"] += 1
+    return report
+
+
+def run(args):
+    workdir = os.path.abspath(args.workdir)
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+
+    stub = subprocess.Popen(
+        [
+            sys.executable, os.path.join(ROOT, "funpay_stub.py"),
+            "--port", str(args.port), "--last-id", str(args.ids),
+            "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+            "--not-found-rate", str(args.not_found_rate), "--max-rps", str(args.max_rps),
+            "--rate-limit-rate", str(args.rate_limit_rate),
+            "--truncate-rate", str(args.truncate_rate), "--seed", str(args.seed),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_stub(args.port)
+        command = [
+            sys.executable, os.path.join(ROOT, "parser.py"),
+            "--base-url", f"http://127.0.0.1:{args.port}", "--end-id", str(args.ids), "--metrics-port", "0",
+        ]
+        if args.shards:
+            command += ["--shards", str(args.shards)]
+
+        print(f"[ℹ] Обход {args.ids} ID через стенд, лог парсера: {os.path.join(workdir, 'parser.log')}")
+        started = time.perf_counter()
+        with open(os.path.join(workdir, "parser.log"), "w", encoding="utf-8") as log:
+            parser = subprocess.Popen(command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+            try:
+                _, status, usage = os.wait4(parser.pid, 0)
+            except KeyboardInterrupt:
+                parser.terminate()
+                raise
+            parser.returncode = os.waitstatus_to_exitcode(status)
+        elapsed = time.perf_counter() - started
+        stats = read_stats(args.port)
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    # При --shards процессорное время дочерних процессов сюда не входит: os.wait4 видит только родителя
+    cpu = usage.ru_utime + usage.ru_stime
+    report = verify(workdir, args.ids, args.not_found_rate, args.seed)
+    print(f"код выхода парсера: {parser.returncode}")
+    print(f"время: {elapsed:.1f} с, {args.ids / elapsed:.1f} ID/с, {report['found'] / elapsed:.1f} найдено/с")
+    print(
+        f"запросов: {stats['requests']} (200: {stats['200']}, 404: {stats['404']}, "
+        f"429: {stats['429']}, оборвано: {stats['truncated']})"
+    )
+    print(f"CPU парсера: {cpu:.2f} с, {cpu / max(stats['requests'], 1) * 1000:.3f} мс на запрос")
+    print(
+        f"результаты: найдено {report['found']}, в ошибках {report['errors']}, потеряно {report['lost']}, "
+        f"дубликатов {report['duplicates']}, неверных ников {report['wrong_name']}, "
+        f"найдено среди 404 {report['found_missing']}"
+    )
+    problems = report["lost"] + report["duplicates"] + report["wrong_name"] + report["found_missing"]
+    if problems or parser.returncode:
+        print("[⚠] Результат неверный.")
+        return 1
+    print("[✔] Результат верный.")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк parser.py на локальном стенде FunPay")
+    parser.add_argument("--ids", type=int, default=20000)
+    parser.add_argument("--port", type=int, default=STUB_PORT)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--not-found-rate", type=float, default=0.1)
+    parser.add_argument("--max-rps", type=float, default=1000)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0005)
+    parser.add_argument("--truncate-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shards", type=int, default=0, help="запустить парсер в режиме нескольких процессов")
+    parser.add_argument("--workdir", default=os.path.join("bench_data", "parser"))
+    args = parser.parse_args()
+    sys.exit(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,18 @@ import os
 import logging
 import sqlite3
 import asyncio
+import time
+import tempfile
+from collections import Counter
+from concurrent.futures.process import BrokenProcessPool
 from telegram import Update
 from telegram.error import TimedOut
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, filters
+from users_index import USER_URL, QueryCache, SearchEngine, dataset_generation
+import users_db
+from refresh_store import REFRESH_DB_FILE
+from users_meta import count_records
+from users_export import ExportCache
 
 
 logging.basicConfig(
@@ -17,16 +26,58 @@ TOKEN = ""
 
 SEARCH_MODE = "match"
 
+# Хранилище пользователей: "file" (users_funpay.txt) или "sqlite" (users_funpay.db, импорт через users_db.py)
+STORAGE_MODE = "file"
+
 # ID админа в Telegram
 ADMIN_ID = 
 
 # Имя файла базы данных
 DATABASE_FILE = "authorized_keys.db"
 
+# Число процессов поиска: индекс пользователей делится между ними на шарды
+SEARCH_WORKERS = os.cpu_count() or 1
+
+# Смены ника из режима --refresh (users_refresh.db) индекс накладывает поверх файла
+search_engine = SearchEngine("users_funpay.txt", SEARCH_WORKERS, REFRESH_DB_FILE)
+
+# Сколько последних запросов /find хранить в кэше результатов
+QUERY_CACHE_SIZE = 1000
+
+query_cache = QueryCache(QUERY_CACHE_SIZE)
+
+# Сжатые части для /users собираются один раз на версию данных (см. users_export.py)
+export_cache = ExportCache("users_funpay")
+
+
+# Сколько запросов get_chat выполнять одновременно в /keys
+KEYS_RESOLVE_CONCURRENCY = 20
+
+# Сколько секунд помнить юзернейм пользователя
+USERNAME_CACHE_TTL = 3600
+
+# Если список ключей не влезает в столько сообщений — отправляем файлом
+KEYS_MAX_MESSAGES = 5
+
+# Лимит длины сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+username_cache = {}
+
+
+# Единственное соединение с базой и копия ключей и банов в памяти: проверки доступа идут без SQL
+db_conn = None
+authorized_keys = {}
+authorized_users = Counter()
+banned_users = set()
+
 
 def init_db():
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        cursor = conn.cursor()
+    global db_conn
+    db_conn = sqlite3.connect(DATABASE_FILE, check_same_thread=False)
+    db_conn.execute("PRAGMA journal_mode=WAL")
+    with db_conn:
+        cursor = db_conn.cursor()
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS authorized_keys (
                 key TEXT PRIMARY KEY,
@@ -38,82 +89,83 @@ def init_db():
                 user_id INTEGER PRIMARY KEY
             )
         """)
-        conn.commit()
 
 
         cursor.execute("INSERT OR IGNORE INTO authorized_keys (key, user_id) VALUES (?, ?)", ("admin", ADMIN_ID))
-        conn.commit()
+
+    for key, user_id in db_conn.execute("SELECT key, user_id FROM authorized_keys"):
+        set_key_owner(key, user_id)
+    banned_users.update(row[0] for row in db_conn.execute("SELECT user_id FROM banned_users"))
+
+
+def set_key_owner(key: str, user_id: int = None):
+    previous = authorized_keys.pop(key, None)
+    if previous is not None:
+        authorized_users[previous] -= 1
+        if authorized_users[previous] <= 0:
+            del authorized_users[previous]
+    if user_id is not None:
+        authorized_users[user_id] += 1
+    authorized_keys[key] = user_id
 
 
 def add_key_to_db(key: str, user_id: int = None):
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT OR IGNORE INTO authorized_keys (key, user_id) VALUES (?, ?)", (key, user_id))
-        conn.commit()
+    with db_conn:
+        db_conn.execute("INSERT OR IGNORE INTO authorized_keys (key, user_id) VALUES (?, ?)", (key, user_id))
+    if key not in authorized_keys:
+        set_key_owner(key, user_id)
 
 
 def delete_key_from_db(key: str):
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM authorized_keys WHERE key = ?", (key,))
-        conn.commit()
-        return cursor.rowcount > 0
+    with db_conn:
+        cursor = db_conn.execute("DELETE FROM authorized_keys WHERE key = ?", (key,))
+    if key in authorized_keys:
+        set_key_owner(key, None)
+        del authorized_keys[key]
+    return cursor.rowcount > 0
 
 
 def ban_user(user_id: int):
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT OR IGNORE INTO banned_users (user_id) VALUES (?)", (user_id,))
-        conn.commit()
+    with db_conn:
+        db_conn.execute("INSERT OR IGNORE INTO banned_users (user_id) VALUES (?)", (user_id,))
+    banned_users.add(user_id)
 
 
 def unban_user(user_id: int):
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM banned_users WHERE user_id = ?", (user_id,))
-        conn.commit()
-        return cursor.rowcount > 0
+    with db_conn:
+        cursor = db_conn.execute("DELETE FROM banned_users WHERE user_id = ?", (user_id,))
+    banned_users.discard(user_id)
+    return cursor.rowcount > 0
 
 
 def is_user_banned(user_id: int) -> bool:
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM banned_users WHERE user_id = ?", (user_id,))
-        return cursor.fetchone() is not None
+    return user_id in banned_users
 
 
 def is_key_activated(key: str) -> bool:
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM authorized_keys WHERE key = ?", (key,))
-        result = cursor.fetchone()
-        return result is not None and result[0] is not None
+    return authorized_keys.get(key) is not None
 
 
 def activate_key(key: str, user_id: int):
     if is_user_banned(user_id):
         return False
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE authorized_keys SET user_id = ? WHERE key = ? AND user_id IS NULL", (user_id, key))
-        conn.commit()
-        return cursor.rowcount > 0
+    if key not in authorized_keys or authorized_keys[key] is not None:
+        return False
+    with db_conn:
+        cursor = db_conn.execute("UPDATE authorized_keys SET user_id = ? WHERE key = ? AND user_id IS NULL", (user_id, key))
+    if cursor.rowcount > 0:
+        set_key_owner(key, user_id)
+    return cursor.rowcount > 0
 
 
 def is_authorized(user_id: int) -> bool:
     if user_id == ADMIN_ID:
         return True
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT key FROM authorized_keys WHERE user_id = ?", (user_id,))
-        return cursor.fetchone() is not None
+    return user_id in authorized_users
 
 
 def load_keys_from_db():
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT key, user_id FROM authorized_keys")
-        return {row[0]: row[1] for row in cursor.fetchall()}
+    return dict(authorized_keys)
 
 
 init_db()
@@ -193,17 +245,22 @@ async def users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     logger.info(f"Пользователь {update.message.from_user.username} запросил файл users_funpay.txt")
-    file_path = "users_funpay.txt"
+    file_path = users_storage_path()
     if os.path.exists(file_path):
-        file_size = os.path.getsize(file_path)
-        if file_size > 50 * 1024 * 1024:  
-            await update.message.reply_text("Файл слишком большой. Разделяю на части...")
-            part_files = split_file(file_path)
-            for part_file in part_files:
-                await send_file_with_retry(update, context, part_file, f"Файл users_funpay.txt, часть {part_files.index(part_file) + 1}/{len(part_files)}")
-                os.remove(part_file) 
-        else:
+        if STORAGE_MODE == "file" and os.path.getsize(file_path) <= 50 * 1024 * 1024:
             await send_file_with_retry(update, context, file_path, "Файл users_funpay.txt")
+            return
+
+        if STORAGE_MODE == "sqlite":
+            part_files = await export_cache.get_parts(
+                file_path, (file_path, f"{file_path}-wal"),
+                prepare=lambda text_path: users_db.export_users(file_path, text_path),
+            )
+        else:
+            await update.message.reply_text("Файл слишком большой, отправляю сжатыми частями...")
+            part_files = await export_cache.get_parts(file_path, (file_path,))
+        for number, part_file in enumerate(part_files, start=1):
+            await send_file_with_retry(update, context, part_file, f"Файл users_funpay.txt, часть {number}/{len(part_files)}")
     else:
         await update.message.reply_text("Файл users_funpay.txt не найден")
 
@@ -221,6 +278,29 @@ async def errors_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await send_file_with_retry(update, context, "errors_funpay.txt", "Файл errors_funpay.txt")
 
 
+def users_storage_path() -> str:
+    return users_db.USERS_DB_FILE if STORAGE_MODE == "sqlite" else "users_funpay.txt"
+
+
+async def search_users(nickname: str, mode: str):
+    storage_path = users_storage_path()
+    if STORAGE_MODE == "sqlite":
+        generation = dataset_generation(storage_path, f"{storage_path}-wal")
+    else:
+        generation = dataset_generation(storage_path, REFRESH_DB_FILE, f"{REFRESH_DB_FILE}-wal")
+    key = (nickname.lower(), mode)
+    found = query_cache.get(key, generation)
+    if found is not None:
+        return found
+
+    if STORAGE_MODE == "sqlite":
+        found = await asyncio.to_thread(users_db.search, users_db.USERS_DB_FILE, nickname, mode)
+    else:
+        found = await search_engine.search(nickname, mode)
+    query_cache.put(key, generation, found)
+    return found
+
+
 def get_user_text(count: int) -> str:
     last_digit = count % 10
     last_two_digits = count % 100
@@ -256,18 +336,11 @@ async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"🔎 Начал поиск '{nickname}'")
         
 
-        if os.path.exists("users_funpay.txt"):
-            with open("users_funpay.txt", "r", encoding="utf-8") as file:
-                lines = file.readlines()
-                found_lines = []
-
-                for line in lines:
-                    if " - " in line:
-                        url, username = line.strip().split(" - ", 1)
-                        if SEARCH_MODE == "strict" and username.lower() == nickname.lower():
-                            found_lines.append(f"{username} - {url}\n")
-                        elif SEARCH_MODE == "match" and nickname.lower() in username.lower():
-                            found_lines.append(f"{username} - {url}\n")
+        if os.path.exists(users_storage_path()):
+            found_lines = [
+                f"{username} - {USER_URL.format(found_id)}\n"
+                for found_id, username in await search_users(nickname, SEARCH_MODE)
+            ]
 
             if found_lines:
 
@@ -294,6 +367,9 @@ async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Файл users_funpay.txt не найден")
     except IndexError:
         await update.message.reply_text("Используйте команду так: /find <ник>")
+    except BrokenProcessPool:
+        logger.error(f"Процесс поиска упал во время запроса '{nickname}', он будет перезапущен")
+        await update.message.reply_text("❌ Поиск временно недоступен, попробуйте еще раз через минуту")
 
 
 async def check_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -305,12 +381,13 @@ async def check_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ У вас нет доступа к этой команде")
         return
 
-    if os.path.exists("users_funpay.txt"):
-        await update.message.reply_text(f"👀 Проверяю базу данных")
-        with open("users_funpay.txt", "r", encoding="utf-8") as file:
-            lines = file.readlines()
-            count = len(lines)
-            await update.message.reply_text(f"Количество пользователей в базе данных: {count}")
+    if STORAGE_MODE == "sqlite" and os.path.exists(users_db.USERS_DB_FILE):
+        count = await asyncio.to_thread(users_db.count_users, users_db.USERS_DB_FILE)
+        await update.message.reply_text(f"Количество пользователей в базе данных: {count}")
+    elif os.path.exists("users_funpay.txt"):
+        # Метаданные обновляют парсер и чекер, бот их только читает
+        count = await asyncio.to_thread(count_records, "users_funpay.txt", False)
+        await update.message.reply_text(f"Количество пользователей в базе данных: {count}")
     else:
         await update.message.reply_text("Файл users_funpay.txt не найден")
 
@@ -470,63 +547,102 @@ async def keys_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ У вас нет прав для просмотра ключей")
         return
 
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT key, user_id FROM authorized_keys")
-        keys = cursor.fetchall()
+    keys = load_keys_from_db().items()
 
-        if not keys:
-            await update.message.reply_text("❌ В базе данных нет ключей")
-            return
+    if not keys:
+        await update.message.reply_text("❌ В базе данных нет ключей")
+        return
 
-        response = "Активные ключи и пользователи:\n\n"
-        for key, user_id in keys:
-            if user_id is not None:
-                try:
-                    user = await context.bot.get_chat(user_id)
-                    username = f"@{user.username}" if user.username else "нет юзернейма"
-                    response += f"{key} - {username} (ID: {user_id})\n\n"
-                except Exception as e:
-                    response += f"{key} - пользователь не найден (ID: {user_id})\n\n"
-            else:
-                response += f"{key} - не активирован\n\n"
+    semaphore = asyncio.Semaphore(KEYS_RESOLVE_CONCURRENCY)
+    user_ids = {user_id for _, user_id in keys if user_id is not None}
+    usernames = dict(zip(user_ids, await asyncio.gather(
+        *(resolve_username(context.bot, user_id, semaphore) for user_id in user_ids)
+    )))
+
+    entries = []
+    for key, user_id in keys:
+        if user_id is None:
+            entries.append(f"{key} - не активирован\n\n")
+        elif usernames[user_id] is None:
+            entries.append(f"{key} - пользователь не найден (ID: {user_id})\n\n")
+        else:
+            entries.append(f"{key} - {usernames[user_id]} (ID: {user_id})\n\n")
+
+    messages = split_message("Активные ключи и пользователи:\n\n", entries)
+    if len(messages) > KEYS_MAX_MESSAGES:
+        fd, file_path = tempfile.mkstemp(prefix="keys_", suffix=".txt")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write("".join(messages))
+        try:
+            await send_file_with_retry(update, context, file_path, f"Ключей: {len(entries)}")
+        finally:
+            os.remove(file_path)
+    else:
+        for message in messages:
+            await update.message.reply_text(message)
 
-        await update.message.reply_text(response)
 
+async def resolve_username(bot, user_id: int, semaphore: asyncio.Semaphore):
+    cached = username_cache.get(user_id)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+
+    async with semaphore:
+        try:
+            user = await bot.get_chat(user_id)
+        except Exception:
+            return None
+    username = f"@{user.username}" if user.username else "нет юзернейма"
+    username_cache[user_id] = (username, time.monotonic() + USERNAME_CACHE_TTL)
+    return username
+
+
+def split_message(header: str, entries, limit: int = MESSAGE_LIMIT):
+    messages = []
+    current = header
+    for entry in entries:
+        if len(current) + len(entry) > limit and current:
+            messages.append(current)
+            current = ""
+        current += entry
+    if current:
+        messages.append(current)
+    return messages
+
+
+async def cache_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await check_ban(update, context):
+        return
+
+    user_id = update.message.from_user.id
+    if user_id != ADMIN_ID:
+        await update.message.reply_text("❌ У вас нет прав для просмотра статистики кэша")
+        return
 
-def split_file(file_path, chunk_size=20 * 1024 * 1024):  # 20 МБ
-    part_files = []
-    part_num = 1
-    current_size = 0
-    current_lines = []
+    requests = query_cache.hits + query_cache.misses
+    hit_rate = query_cache.hits / requests * 100 if requests else 0
+    await update.message.reply_text(
+        f"Кэш поиска: {len(query_cache.entries)}/{query_cache.max_size} запросов\n"
+        f"Попадания: {query_cache.hits}, промахи: {query_cache.misses} ({hit_rate:.1f}% попаданий)"
+    )
 
-    with open(file_path, "r", encoding="utf-8") as file:
-        for line in file:
-            line_size = len(line.encode("utf-8"))
-            if current_size + line_size > chunk_size and current_lines:
-                part_file_path = f"{file_path}.part{part_num}"
-                with open(part_file_path, "w", encoding="utf-8") as part_file:
-                    part_file.writelines(current_lines)
-                part_files.append(part_file_path)
-                part_num += 1
-                current_lines = []
-                current_size = 0
 
-            current_lines.append(line)
-            current_size += line_size
+async def post_init(application):
+    if STORAGE_MODE == "file":
+        await search_engine.warmup()
+        logger.info("Индекс пользователей загружен.")
 
-        if current_lines:
-            part_file_path = f"{file_path}.part{part_num}"
-            with open(part_file_path, "w", encoding="utf-8") as part_file:
-                part_file.writelines(current_lines)
-            part_files.append(part_file_path)
 
-    return part_files
+async def post_shutdown(application):
+    search_engine.shutdown()
 
 
 def main():
     logger.info("Запуск бота...")
-    application = ApplicationBuilder().token(TOKEN).read_timeout(30).write_timeout(30).build()
+    application = (
+        ApplicationBuilder().token(TOKEN).read_timeout(30).write_timeout(30)
+        .post_init(post_init).post_shutdown(post_shutdown).build()
+    )
 
 
     application.add_handler(CommandHandler("start", start_command))
@@ -541,6 +657,7 @@ def main():
     application.add_handler(CommandHandler("ban", ban_command))
     application.add_handler(CommandHandler("unban", unban_command))
     application.add_handler(CommandHandler("keys", keys_command))
+    application.add_handler(CommandHandler("cache", cache_command))
 
 
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_key_message))
@@ -1,95 +1,386 @@
 import re
 import os
-import tempfile
-import shutil
+import json
+import asyncio
+from users_meta import write_meta
+from error_ledger import ErrorLedger, USER_ID_PATTERN, report_url, report_ids
+from id_bitmap import IdBitmap
+from file_lock import WriterLock
+from users_index import iter_line_blocks
+
+try:
+    import numpy as np
+except ImportError:
+    # Без NumPy пропуски ищутся по байтам битовой карты (см. _gaps_python)
+    np = None
+
+# Строка результата начинается со ссылки на профиль; первая строка файла может начинаться с BOM
+LINE_ID = re.compile(rb"^(?:\xef\xbb\xbf)?https://funpay\.com/users/(\d+)/", re.M)
+BLANK_LINE = re.compile(rb"^[ \t\r]*\n", re.M)
+BOM = b"\xef\xbb\xbf"
+
+# Размер блока при чтении файла результатов
+SCAN_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Состояние чекера между проходами лежит рядом с файлом: users_funpay.txt.checker (смещение,
+# inode, граница проверки пропусков) и users_funpay.txt.checker.bitmap (встреченные ID)
+CHECKER_STATE_SUFFIX = ".checker"
+CHECKER_BITMAP_SUFFIX = ".checker.bitmap"
+CHECKER_STATE_VERSION = 1
+
+# Сколько повторяющихся ID и участков пропусков показывать в отчете
+SHOW_DUPLICATES = 20
+SHOW_GAPS = 20
+
+# Сколько байт битовой карты (по 8 ID) разворачивать за раз при поиске пропусков через NumPy
+GAP_BLOCK_BYTES = 1 << 20
 
 def load_error_ids(error_filename):
-    error_ids = set()
+    """ ID из отчета об ошибках в виде битовой карты; участки добавляются целиком """
+    error_ids = IdBitmap()
     try:
         with open(error_filename, "r", encoding="utf-8") as file:
             for line in file:
-                match = re.search(r"https://funpay.com/users/(\d+)/", line)
+                match = USER_ID_PATTERN.search(line)
                 if match:
-                    error_ids.add(int(match.group(1)))
+                    ids = report_ids(match)
+                    error_ids.add_range(ids.start, ids.stop - 1)
     except FileNotFoundError:
         pass
     return error_ids
 
-def clean_and_check_file(filename, error_filename):
-    error_ids = load_error_ids(error_filename)
 
+class FileScan:
+    """ Разбор файла результатов по целым строкам без хранения их текста.
 
-    with tempfile.NamedTemporaryFile(mode="w+", encoding="utf-8", delete=False) as temp_file:
-        temp_filename = temp_file.name
+    Встреченные ID лежат в битовой карте, а смещение последней строки хранится только
+    для ID, которые встретились больше одного раза, поэтому память зависит от числа ID,
+    а не от объема файла. Состояние сохраняется между проходами (save/resume), и следующий
+    проход разбирает только дописанные строки; файл перечитывается целиком, только если
+    его заменили или обрезали. gaps_until — до какого ID пропуски уже проверены.
+    """
 
+    def __init__(self, path):
+        self.path = path
+        self._reset()
 
-        seen_lines = set()
-        duplicates = set()
+    def _reset(self):
+        self.inode = None
+        self.offset = 0
+        self.lines = 0
+        self.blank = 0
+        self.duplicates = 0
+        self.seen = IdBitmap()
+        self.last = {}
+        self.gaps_until = None
+        self.scanned = 0
 
+    @classmethod
+    def resume(cls, path):
+        """ Скан с сохраненного состояния, если оно построено по этому же файлу, иначе пустой """
+        scan = cls(path)
+        try:
+            with open(path + CHECKER_STATE_SUFFIX, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            stat = os.stat(path)
+        except (FileNotFoundError, ValueError):
+            return scan
+        saved = IdBitmap.load(path + CHECKER_BITMAP_SUFFIX)
+        if (
+            state.get("version") != CHECKER_STATE_VERSION
+            or saved is None
+            or (saved[1], saved[2]) != (state["offset"], state["inode"])
+            or state["inode"] != stat.st_ino
+            or not 0 < state["offset"] <= stat.st_size
+        ):
+            return scan
+        with open(path, "rb") as f:
+            f.seek(state["offset"] - 1)
+            if f.read(1) != b"\n":
+                return scan
+        scan.seen = saved[0]
+        scan.inode = state["inode"]
+        scan.offset = state["offset"]
+        scan.lines = state["lines"]
+        scan.gaps_until = state["gaps_until"]
+        return scan
 
-        seen_ids = set()
+    def save(self):
+        """ Сохраняет состояние: сначала карту ID, затем атомарно JSON с тем же смещением и inode """
+        if self.inode is None:
+            return
+        self.seen.save(self.path + CHECKER_BITMAP_SUFFIX, self.offset, self.inode)
+        state = {
+            "version": CHECKER_STATE_VERSION,
+            "offset": self.offset,
+            "inode": self.inode,
+            "lines": self.lines,
+            "gaps_until": self.gaps_until,
+        }
+        temp_path = self.path + CHECKER_STATE_SUFFIX + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.path + CHECKER_STATE_SUFFIX)
 
+    def feed(self, size=None):
+        """ Разбирает целые строки от offset до size (по умолчанию до конца файла).
+        Если файл заменен или стал короче offset, разбор начинается заново """
+        with open(self.path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            if self.inode != stat.st_ino or stat.st_size < self.offset:
+                self._reset()
+                self.inode = stat.st_ino
+            size = stat.st_size if size is None else size
+            f.seek(self.offset)
+            for block in iter_line_blocks(f, size, SCAN_CHUNK_SIZE):
+                self._scan(block, len(block))
+                self.offset += len(block)
+                self.scanned += len(block)
+        return self
 
-        min_id = float('inf')
-        max_id = float('-inf')
+    def gap_range(self, limit_id=None):
+        """ [low, high) для поиска пропусков: от границы прошлого прохода (или наименьшего ID)
+        до наибольшего найденного ID, но не дальше limit_id """
+        low, high = self.seen.min_id(), self.seen.max_id()
+        if low is None:
+            return 0, 0
+        if self.gaps_until is not None:
+            low = max(low, self.gaps_until)
+        if limit_id is not None:
+            high = min(high, limit_id)
+        return low, max(low, high)
 
+    def _scan(self, data, end):
+        seen, last, base = self.seen, self.last, self.offset
+        self.lines += data.count(b"\n", 0, end)
+        self.blank += len(BLANK_LINE.findall(data, 0, end))
+        for match in LINE_ID.finditer(data, 0, end):
+            user_id = int(match.group(1))
+            if user_id in seen:
+                last[user_id] = base + match.start()
+                self.duplicates += 1
+            else:
+                seen.add(user_id)
+
+    def needs_rewrite(self):
+        return bool(self.duplicates or self.blank)
+
+    def dropped(self, data, end, base):
+        """ Участки [начало, конец) строк блока, которые не попадут в новый файл:
+        пустые строки и все строки повторяющегося ID, кроме последней """
+        spans = [match.span() for match in BLANK_LINE.finditer(data, 0, end)]
+        last = self.last
+        for match in LINE_ID.finditer(data, 0, end):
+            user_id = int(match.group(1))
+            if user_id in last and last[user_id] != base + match.start():
+                spans.append((match.start(), data.index(b"\n", match.start()) + 1))
+        spans.sort()
+        return spans
+
+
+def rewrite_file(scan):
+    """ Дочитывает хвост и атомарно заменяет файл копией без пустых строк и старых строк
+    повторяющихся ID. В файл в это время никто не должен писать. Возвращает число удаленных строк """
+    scan.feed()
+    temp_path = scan.path + ".tmp"
+    removed = 0
+    with open(scan.path, "rb") as src, open(temp_path, "wb") as dst:
+        base = 0
+        pending = b""
+        for data in iter_line_blocks(src, chunk_size=SCAN_CHUNK_SIZE, tail=True):
+            if not data.endswith(b"\n"):
+                pending = data
+                break
+            cut = len(data)
+            kept_from = 0
+            for start, end in scan.dropped(data, cut, base):
+                # BOM в начале файла остается, даже если первая строка удалена
+                if base == 0 and start == 0 and data.startswith(BOM):
+                    start = len(BOM)
+                dst.write(data[kept_from:start])
+                kept_from = end
+                removed += 1
+            dst.write(data[kept_from:cut])
+            base += cut
+        # Недописанная последняя строка переносится как есть
+        dst.write(pending)
+        dst.flush()
+        os.fsync(dst.fileno())
+        size = dst.tell()
+    os.replace(temp_path, scan.path)
+
+    # Состояние переносится на новый файл: ID те же, повторов и пустых строк больше нет
+    scan.inode = os.stat(scan.path).st_ino
+    scan.offset = size - len(pending)
+    scan.lines -= removed
+    scan.last = {}
+    scan.blank = scan.duplicates = 0
+    write_meta(scan.path, scan.lines, scan.offset, scan.inode)
+    return removed
 
-        with open(filename, "r", encoding="utf-8") as file:
-            for line in file:
-                stripped_line = line.strip()
-                if stripped_line in seen_lines:
-                    duplicates.add(stripped_line)
-                else:
-                    seen_lines.add(stripped_line)
-                    temp_file.write(stripped_line + "\n")
-
-
-                    match = re.search(r"https://funpay.com/users/(\d+)/", stripped_line)
-                    if match:
-                        user_id = int(match.group(1))
-                        seen_ids.add(user_id)
-                        if user_id < min_id:
-                            min_id = user_id
-                        if user_id > max_id:
-                            max_id = user_id
-
-
-        if duplicates:
-            print("🔴 Найдены дубликаты строк:")
-            for dup in duplicates:
-                print(dup)
-        else:
-            print("✅ Дубликатов не найдено.")
 
+def _gaps_numpy(bits, low, high):
+    """ Участки нулевых битов в [low, high): карта разворачивается блоками, границы участков — np.diff """
+    gaps = []
+    for start in range(low >> 3, ((high - 1) >> 3) + 1, GAP_BLOCK_BYTES):
+        stop = min(start + GAP_BLOCK_BYTES, ((high - 1) >> 3) + 1)
+        missing = np.unpackbits(np.frombuffer(bits, np.uint8, stop - start, start), bitorder="little") == 0
+        base = start << 3
+        head = max(low - base, 0)
+        missing = missing[head:high - base]
+        base += head
+        edges = np.diff(missing.astype(np.int8), prepend=np.int8(0), append=np.int8(0))
+        firsts = (np.flatnonzero(edges == 1) + base).tolist()
+        lasts = (np.flatnonzero(edges == -1) + base - 1).tolist()
+        for first, last in zip(firsts, lasts):
+            # Участок, разрезанный границей блока, склеивается
+            if gaps and gaps[-1][1] == first - 1:
+                gaps[-1] = (gaps[-1][0], last)
+            else:
+                gaps.append((first, last))
+    return gaps
 
-        temp_file.close()
 
+def _gaps_python(covered, low, high):
+    """ Участки пропусков в [low, high): заполненные и пустые байты карты пропускаются целиком """
+    return list(covered.missing_ranges(low, high - 1))
 
-        with open(temp_filename, "r", encoding="utf-8") as src, open(filename, "w", encoding="utf-8") as dst:
-            shutil.copyfileobj(src, dst)
+
+def _or_bits(target, part):
+    """ target |= part побайтно: через NumPy, а без него одной операцией над большими целыми """
+    size = len(part)
+    if not size:
+        return
+    if np is not None:
+        view = np.frombuffer(target, np.uint8, size)
+        np.bitwise_or(view, np.frombuffer(part, np.uint8), out=view)
+    else:
+        merged = int.from_bytes(target[:size], "little") | int.from_bytes(part, "little")
+        target[:size] = merged.to_bytes(size, "little")
 
 
-        os.remove(temp_filename)
+def find_gaps(seen, error_ids, low, high, extra_ids=()):
+    """ Участки (первый, последний) ID из [low, high), которых нет ни в файле, ни в ошибках.
+    error_ids — битовая карта ошибок, она накладывается на карту файла побайтным OR;
+    extra_ids — небольшое множество ID, которые тоже не считаются пропусками.
+    Разбирается только часть карт между low и high """
+    if high <= low:
+        return []
+    first_byte = low >> 3
+    end_byte = ((high - 1) >> 3) + 1
+    shift = first_byte << 3
+    covered = IdBitmap(bytearray(seen.bits[first_byte:end_byte]), 0)
+    _or_bits(covered.bits, error_ids.bits[first_byte:first_byte + len(covered.bits)])
+    covered.update(user_id - shift for user_id in extra_ids if low <= user_id < high)
+    if np is not None:
+        gaps = _gaps_numpy(covered.bits, low - shift, high - shift)
+    else:
+        gaps = _gaps_python(covered, low - shift, high - shift)
+    return [(first + shift, last + shift) for first, last in gaps]
 
 
-    if min_id != float('inf') and max_id != float('-inf'):
-        missing_ids = set()
-        for user_id in range(min_id, max_id + 1):
-            if user_id not in seen_ids and user_id not in error_ids:
-                missing_ids.add(user_id)
+def report_scan(scan):
+    if scan.scanned == scan.offset:
+        print(f"[ℹ] Файл разобран целиком: {scan.lines} строк.")
+    else:
+        print(f"[ℹ] Разобрано {scan.scanned} новых байт, всего строк {scan.lines}.")
+    if scan.duplicates:
+        print(f"🔴 Найдено {scan.duplicates} повторных строк у {len(scan.last)} ID, оставлены последние:")
+        for user_id in sorted(scan.last)[:SHOW_DUPLICATES]:
+            print(f"https://funpay.com/users/{user_id}/")
+        if len(scan.last) > SHOW_DUPLICATES:
+            print(f"... и еще {len(scan.last) - SHOW_DUPLICATES} ID")
     else:
-        missing_ids = set()
+        print("✅ Дубликатов не найдено.")
+
+
+def report_removed(removed):
+    if removed:
+        print(f"[ℹ] Из файла удалено {removed} строк (повторы и пустые строки).")
+
 
-    if missing_ids:
+def record_missing(gaps, error_filename, ledger=None):
+    """ Записывает участки пропусков в ошибки: одна строка на участок, а не на каждый ID.
+    Возвращает действительно записанные участки """
+    if ledger is not None:
+        # Пока файл разбирался, часть ID могла попасть в журнал сама — такие fail_range пропускает
+        gaps = [added for first, last in gaps for added in ledger.fail_range(first, last, "missing", "error")]
+    elif gaps:
         with open(error_filename, "a", encoding="utf-8") as error_file:
-            for missing_id in sorted(missing_ids):
-                error_file.write(f"https://funpay.com/users/{missing_id}/ - error\n")
+            for first, last in gaps:
+                error_file.write(f"{report_url(first, last)} - error\n")
 
-        print("\n⚠️ Новые пропущенные ID добавлены в errors_funpay.txt:")
-        for missing_id in sorted(missing_ids):
-            print(f"https://funpay.com/users/{missing_id}/ - missing")
+    if gaps:
+        total = sum(last - first + 1 for first, last in gaps)
+        print(f"\n⚠️ Новые пропущенные ID ({total} в {len(gaps)} участках) добавлены в errors_funpay.txt:")
+        for first, last in gaps[:SHOW_GAPS]:
+            print(f"{report_url(first, last)} - missing")
+        if len(gaps) > SHOW_GAPS:
+            print(f"... и еще {len(gaps) - SHOW_GAPS} участков")
     else:
         print("\n✅ Все ID идут по порядку, новых ошибок нет.")
+    return gaps
 
 
-clean_and_check_file("users_funpay.txt", "errors_funpay.txt")
\ No newline at end of file
+def clean_and_check_file(filename, error_filename, ledger=None):
+    """ Удаляет повторы по ID (остается последняя строка, например после повторного обхода ID)
+    и записывает в ошибки ID, пропущенные между наименьшим и наибольшим найденным """
+    if not os.path.exists(filename):
+        print(f"[⚠] Файл {filename} не найден.")
+        return False
+    error_ids = ledger.ids if ledger is not None else load_error_ids(error_filename)
+    scan = FileScan.resume(filename).feed()
+    report_scan(scan)
+    removed = rewrite_file(scan) if scan.needs_rewrite() else 0
+    report_removed(removed)
+    low, high = scan.gap_range()
+    record_missing(find_gaps(scan.seen, error_ids, low, high), error_filename, ledger)
+    scan.gaps_until = high
+    scan.save()
+    return removed > 0
+
+
+async def check_file_in_background(filename, error_filename, ledger, writer=None, skip_ids=(), limit_id=None):
+    """ clean_and_check_file без остановки цикла событий: файл разбирается в потоке,
+    а замена идет внутри задачи записи writer (см. ResultWriter.exclusive), пока строки копятся в ее очереди.
+    skip_ids — ID в работе, которые еще не успели попасть ни в файл, ни в журнал; limit_id — первый ID,
+    выданный после снимка skip_ids. Возвращает (True, если файл был заменен; записанные в журнал участки пропусков) """
+    if not os.path.exists(filename):
+        print(f"[⚠] Файл {filename} не найден.")
+        return False, []
+    # Копия карты ошибок на момент снимка: поток читает ее, пока цикл событий дописывает журнал
+    error_ids = IdBitmap(bytearray(ledger.ids.bits), len(ledger.ids))
+    if writer is not None:
+        # Строки ID, завершенных до снимка, должны быть на диске до разбора
+        await writer.flush()
+    scan = await asyncio.to_thread(lambda: FileScan.resume(filename).feed())
+    report_scan(scan)
+    removed = 0
+    if scan.needs_rewrite():
+        if writer is not None:
+            removed = await writer.exclusive(rewrite_file, scan)
+        else:
+            removed = await asyncio.to_thread(rewrite_file, scan)
+    report_removed(removed)
+    low, high = scan.gap_range(limit_id)
+    gaps = await asyncio.to_thread(find_gaps, scan.seen, error_ids, low, high, skip_ids)
+    # Журнал ошибок меняется только из цикла событий
+    gaps = record_missing(gaps, error_filename, ledger)
+    scan.gaps_until = high
+    await asyncio.to_thread(scan.save)
+    return removed > 0, gaps
+
+
+if __name__ == "__main__":
+    # Пока работает парсер, файл проверяет его собственный чекер; замена из другого процесса потеряла бы его строки
+    lock = WriterLock("users_funpay.txt")
+    if not lock.acquire():
+        raise SystemExit("[❌] В users_funpay.txt сейчас пишет парсер, он проверяет файл сам. Запустите checker.py после его остановки.")
+    try:
+        ledger = ErrorLedger("errors_funpay.txt")
+        try:
+            clean_and_check_file("users_funpay.txt", "errors_funpay.txt", ledger)
+        finally:
+            ledger.close()
+    finally:
+        lock.release()
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import heapq
+import random
+from id_bitmap import IdBitmap
+
+# Чекпоинт хранится рядом с файлом результатов: users_funpay.txt.checkpoint
+CHECKPOINT_VERSION = 3
+
+# Экспоненциальная задержка повтора: 30 с, 60 с, 120 с... но не больше 6 часов, ±50% случайно
+RETRY_BASE_DELAY = 30
+RETRY_MAX_DELAY = 6 * 60 * 60
+RETRY_JITTER = 0.5
+
+
+def retry_delay(attempts):
+    """ Задержка перед следующей попыткой после attempts неудачных """
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** min(max(attempts - 1, 0), 32))
+    return delay * random.uniform(1 - RETRY_JITTER, 1 + RETRY_JITTER)
+
+
+class CrawlFrontier:
+    """ Граница обхода: следующий новый ID, ID, выданные воркерам, и ID, ждущие повтора.
+
+    Повторы лежат в куче участками (время следующей попытки в unix time, первый, последний),
+    поэтому воркеры получают их вперемешку с новыми ID по мере наступления срока, а не пачкой.
+    Участок созревает целиком и выдается по одному ID; пропуск на миллионы ID занимает одну
+    запись кучи, а какие ID уже ждут повтора, помнит битовая карта waiting.
+
+    Все ID меньше next_id уже выданы: они либо в файле результатов, либо в журнале ошибок,
+    либо в in_flight/retries. Поэтому после рестарта достаточно вернуть в очередь
+    in_flight и retries и продолжить с next_id.
+    """
+
+    def __init__(self, next_id, in_flight=(), retries=()):
+        self.next_id = next_id
+        self.in_flight = set(in_flight)
+        self.retries = [(due, first, last) for first, last, due in retries]
+        heapq.heapify(self.retries)
+        self.waiting = IdBitmap()
+        for due, first, last in self.retries:
+            self.waiting.add_range(first, last)
+
+    def issue(self, user_id):
+        self.in_flight.add(user_id)
+
+    def done(self, user_id):
+        self.in_flight.discard(user_id)
+
+    def schedule_retry(self, first_id, due=0.0, last_id=None):
+        """ Ставит ID first_id..last_id (по умолчанию только first_id) на повтор не раньше due.
+        ID, которые уже ждут повтора или выданы воркерам, не трогает; возвращает число поставленных ID """
+        if last_id is None:
+            last_id = first_id
+        if first_id == last_id:
+            busy = [first_id] if first_id in self.in_flight else []
+        else:
+            busy = sorted(user_id for user_id in self.in_flight if first_id <= user_id <= last_id)
+        scheduled = 0
+        for first, last in list(self.waiting.missing_ranges(first_id, last_id)):
+            for user_id in busy:
+                if first <= user_id <= last:
+                    scheduled += self._push(due, first, user_id - 1)
+                    first = user_id + 1
+            scheduled += self._push(due, first, last)
+        return scheduled
+
+    def _push(self, due, first, last):
+        if last < first:
+            return 0
+        heapq.heappush(self.retries, (due, first, last))
+        self.waiting.add_range(first, last)
+        return last - first + 1
+
+    def is_scheduled(self, user_id):
+        return user_id in self.in_flight or user_id in self.waiting
+
+    def next_retry(self, now):
+        """ ID, срок повтора которого наступил, или None """
+        retries = self.retries
+        if not retries or retries[0][0] > now:
+            return None
+        due, first, last = retries[0]
+        if first == last:
+            heapq.heappop(retries)
+        else:
+            heapq.heapreplace(retries, (due, first + 1, last))
+        self.waiting.discard(first)
+        return first
+
+    def advance(self, processed):
+        """ Выдает next_id и сдвигает его к следующему необработанному ID """
+        user_id = self.next_id
+        self.next_id = processed.next_missing(user_id + 1)
+        return user_id
+
+    def retry_ranges(self):
+        """ Участки (первый, последний) ID, ждущих повтора """
+        return [(first, last) for due, first, last in self.retries]
+
+    def snapshot(self):
+        """ Копия состояния, которую можно сохранить, пока обход продолжается """
+        snapshot = CrawlFrontier(self.next_id, self.in_flight)
+        snapshot.retries = list(self.retries)
+        return snapshot
+
+    def save(self, path, offset=0, inode=0):
+        """ Атомарно сохраняет чекпоинт вместе с позицией в файле результатов """
+        state = {
+            "version": CHECKPOINT_VERSION,
+            "next_id": self.next_id,
+            "in_flight": sorted(self.in_flight),
+            "retries": [[first, last, due] for due, first, last in self.retries],
+            "offset": offset,
+            "inode": inode,
+            "saved": time.time(),
+        }
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """ Возвращает (граница, смещение, inode) или None, если чекпоинта нет или он поврежден """
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("version") != CHECKPOINT_VERSION:
+                return None
+            frontier = cls(state["next_id"], state["in_flight"], [tuple(retry) for retry in state["retries"]])
+            return frontier, state["offset"], state["inode"]
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            return None
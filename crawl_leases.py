@@ -0,0 +1,138 @@
+import os
+import time
+import sqlite3
+
+# Файл с таблицей аренды диапазонов для режима нескольких процессов
+LEASE_DB_FILE = "crawl_leases.db"
+
+# Сколько ID в одном диапазоне
+RANGE_SIZE = 10000
+
+# Аренда без продления дольше LEASE_TTL секунд считается брошенной
+LEASE_TTL = 120
+
+# free — ждет процесса, leased — в работе, done — обойден, merged — перенесен в users_funpay.txt
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS leases (
+        start_id INTEGER PRIMARY KEY,
+        end_id INTEGER NOT NULL,
+        next_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'free',
+        owner TEXT,
+        pid INTEGER,
+        expires REAL
+    );
+    CREATE INDEX IF NOT EXISTS leases_status ON leases (status, start_id);
+"""
+
+
+def pid_alive(pid):
+    """ Жив ли процесс. На Windows os.kill(pid, 0) не проверяет, а завершает процесс,
+    поэтому там процесс всегда считается живым и брошенную аренду освобождает истечение срока """
+    if os.name == "nt":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class LeaseTable:
+    """ Диапазоны ID в локальной SQLite-базе, которые процессы-шарды берут в аренду.
+
+    Процесс берет свободный диапазон с наименьшим началом, а если свободных нет — создает
+    следующий после последнего. Аренда продлевается вместе с прогрессом (next_id), поэтому
+    диапазон упавшего процесса другой процесс продолжает с того же места. Аренда считается
+    брошенной, если истек срок или (кроме Windows) процесса-владельца больше нет.
+    """
+
+    def __init__(self, db_path=LEASE_DB_FILE):
+        self.conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def _transaction(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+
+    def reclaim(self, now=None):
+        """ Освобождает брошенные аренды, возвращает их число """
+        now = time.time() if now is None else now
+        rows = self.conn.execute("SELECT start_id, pid, expires FROM leases WHERE status = 'leased'").fetchall()
+        stale = [start_id for start_id, pid, expires in rows if expires < now or not pid_alive(pid)]
+        for start_id in stale:
+            self.conn.execute(
+                "UPDATE leases SET status = 'free', owner = NULL, pid = NULL, expires = NULL WHERE start_id = ?",
+                (start_id,),
+            )
+        return len(stale)
+
+    def claim(self, owner, first_id, last_id=None, range_size=RANGE_SIZE, ttl=LEASE_TTL):
+        """ Берет диапазон в аренду: (начало, конец, next_id) или None, если до last_id все роздано """
+        self._transaction()
+        try:
+            now = time.time()
+            self.reclaim(now)
+            row = self.conn.execute(
+                "SELECT start_id, end_id, next_id FROM leases WHERE status = 'free' ORDER BY start_id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                top = self.conn.execute("SELECT MAX(end_id) FROM leases").fetchone()[0]
+                start_id = max(first_id, top + 1) if top is not None else first_id
+                if last_id is not None and start_id > last_id:
+                    self.conn.execute("COMMIT")
+                    return None
+                end_id = start_id + range_size - 1
+                if last_id is not None:
+                    end_id = min(end_id, last_id)
+                self.conn.execute(
+                    "INSERT INTO leases (start_id, end_id, next_id) VALUES (?, ?, ?)", (start_id, end_id, start_id)
+                )
+                row = (start_id, end_id, start_id)
+            self.conn.execute(
+                "UPDATE leases SET status = 'leased', owner = ?, pid = ?, expires = ? WHERE start_id = ?",
+                (owner, os.getpid(), now + ttl, row[0]),
+            )
+            self.conn.execute("COMMIT")
+            return row
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def renew(self, start_id, owner, next_id, ttl=LEASE_TTL):
+        """ Продлевает аренду и сохраняет прогресс. False — аренду уже забрали """
+        cursor = self.conn.execute(
+            "UPDATE leases SET next_id = ?, expires = ? WHERE start_id = ? AND owner = ? AND status = 'leased'",
+            (next_id, time.time() + ttl, start_id, owner),
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, start_id, owner):
+        cursor = self.conn.execute(
+            "UPDATE leases SET status = 'done', next_id = end_id + 1, expires = NULL "
+            "WHERE start_id = ? AND owner = ? AND status = 'leased'",
+            (start_id, owner),
+        )
+        return cursor.rowcount == 1
+
+    def release(self, start_id, owner, next_id):
+        """ Возвращает недообойденный диапазон при штатной остановке процесса """
+        self.conn.execute(
+            "UPDATE leases SET status = 'free', next_id = ?, owner = NULL, pid = NULL, expires = NULL "
+            "WHERE start_id = ? AND owner = ? AND status = 'leased'",
+            (next_id, start_id, owner),
+        )
+
+    def completed(self):
+        """ Обойденные, но еще не перенесенные диапазоны """
+        return self.conn.execute(
+            "SELECT start_id, end_id FROM leases WHERE status = 'done' ORDER BY start_id"
+        ).fetchall()
+
+    def mark_merged(self, start_id):
+        self.conn.execute("UPDATE leases SET status = 'merged' WHERE start_id = ? AND status = 'done'", (start_id,))
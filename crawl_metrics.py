@@ -0,0 +1,154 @@
+import time
+import bisect
+import asyncio
+from aiohttp import web
+
+# Метрики отдаются в текстовом формате Prometheus на http://127.0.0.1:METRICS_PORT/metrics
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+
+# Как часто печатать строку со сводкой (в секундах)
+SUMMARY_INTERVAL = 10
+
+# Границы корзин гистограмм в секундах
+REQUEST_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+WRITE_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+
+PREFIX = "funpay_"
+
+
+class Histogram:
+    """ Гистограмма с фиксированными корзинами; последняя корзина — все, что больше границ """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, fraction, counts=None):
+        """ Верхняя граница корзины, в которую попадает квантиль; counts — разность двух снимков """
+        counts = self.counts if counts is None else counts
+        total = sum(counts)
+        if not total:
+            return None
+        running = 0
+        for index, count in enumerate(counts):
+            running += count
+            if running >= fraction * total:
+                return self.buckets[min(index, len(self.buckets) - 1)]
+        return self.buckets[-1]
+
+
+class CrawlMetrics:
+    """ Счетчики, гистограммы и датчики парсера.
+
+    Счетчики и гистограммы обновляются на месте, датчики — функции, которые вызываются
+    при чтении. Сводка за период считается по разнице с предыдущим снимком.
+    """
+
+    def __init__(self, name=""):
+        self.name = name
+        self.counters = {}
+        self.histograms = {
+            "request_seconds": Histogram(REQUEST_BUCKETS),
+            "write_seconds": Histogram(WRITE_BUCKETS),
+        }
+        self.gauges = {}
+        self.previous = self._snapshot()
+
+    def inc(self, name, label=None, value=1):
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def gauge(self, name, callback):
+        self.gauges[name] = callback
+
+    def counter(self, name, label=None):
+        return self.counters.get((name, label), 0)
+
+    def render(self):
+        """ Текст для /metrics в формате Prometheus """
+        lines = []
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f"# TYPE {PREFIX}{name} counter")
+            for (counter_name, label), value in sorted(self.counters.items(), key=lambda item: str(item[0])):
+                if counter_name == name:
+                    labels = f'{{status="{label}"}}' if label is not None else ""
+                    lines.append(f"{PREFIX}{name}{labels} {value}")
+        for name, histogram in self.histograms.items():
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+            running = 0
+            for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                running += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f'{PREFIX}{name}_bucket{{le="{le}"}} {running}')
+            lines.append(f"{PREFIX}{name}_sum {histogram.sum:.6f}")
+            lines.append(f"{PREFIX}{name}_count {histogram.count}")
+        for name, callback in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {PREFIX}{name} gauge")
+            lines.append(f"{PREFIX}{name} {callback()}")
+        return "\n".join(lines) + "\n"
+
+    def _snapshot(self):
+        return {
+            "time": time.monotonic(),
+            "counters": dict(self.counters),
+            "histograms": {name: list(histogram.counts) for name, histogram in self.histograms.items()},
+        }
+
+    def summary(self):
+        """ Строка со сводкой с момента прошлого вызова """
+        current = self._snapshot()
+        previous, self.previous = self.previous, current
+        elapsed = max(current["time"] - previous["time"], 1e-9)
+
+        def delta(name, label=None):
+            return current["counters"].get((name, label), 0) - previous["counters"].get((name, label), 0)
+
+        statuses = sorted(label for name, label in current["counters"] if name == "requests_total")
+        requests = sum(delta("requests_total", status) for status in statuses)
+        status_mix = " ".join(f"{status}: {delta('requests_total', status)}" for status in statuses) or "нет"
+
+        latency = self.histograms["request_seconds"]
+        counts = [
+            now - before
+            for now, before in zip(current["histograms"]["request_seconds"], previous["histograms"]["request_seconds"])
+        ]
+        quantiles = "/".join(
+            f"{value:g}" if value is not None else "-"
+            for value in (latency.quantile(fraction, counts) for fraction in (0.5, 0.9, 0.99))
+        )
+
+        gauges = " | ".join(f"{name} {callback()}" for name, callback in sorted(self.gauges.items()))
+        prefix = f"[📊 {self.name}]" if self.name else "[📊]"
+        return (
+            f"{prefix} {requests / elapsed:.1f} зап/с | найдено {delta('found_total') / elapsed:.1f}/с | "
+            f"{status_mix} | задержка p50/p90/p99 ≤ {quantiles} с | "
+            f"записано {delta('written_lines_total') / elapsed:.1f} строк/с | {gauges}"
+        )
+
+    async def report(self, interval=SUMMARY_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            print(self.summary())
+
+    async def serve(self, host=METRICS_HOST, port=METRICS_PORT):
+        """ Поднимает /metrics, возвращает runner для остановки """
+        async def handle(request):
+            return web.Response(text=self.render(), content_type="text/plain")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
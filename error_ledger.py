@@ -0,0 +1,345 @@
+import os
+import re
+import time
+import bisect
+import threading
+from id_bitmap import IdBitmap
+
+# Журнал ошибок лежит рядом с отчетом: errors_funpay.txt -> errors_funpay.ledger
+#   F<TAB>id<TAB>попытки<TAB>время<TAB>статус<TAB>причина — неудачная попытка
+#   G<TAB>первый<TAB>последний<TAB>попытки<TAB>время<TAB>статус<TAB>причина — то же для всех ID участка
+#   R<TAB>id<TAB>время                                   — ID успешно получен
+#   P<TAB>id<TAB>время                                   — повторы исчерпаны, ID больше не запрашивается
+#   P<TAB>первый<TAB>последний<TAB>время                  — то же для всех ID участка
+LEDGER_EXTENSION = ".ledger"
+
+# Журнал сжимается, когда строк в нем в COMPACT_RATIO раз больше, чем живых участков
+COMPACT_RATIO = 4
+COMPACT_MIN_LINES = 10000
+
+# В отчете участок подряд идущих ID с одной ошибкой пишется одной строкой: users/<первый>-<последний>/
+USER_ID_PATTERN = re.compile(r"https://funpay.com/users/(\d+)(?:-(\d+))?/")
+
+
+def report_url(first_id, last_id=None):
+    if last_id is None or last_id == first_id:
+        return f"https://funpay.com/users/{first_id}/"
+    return f"https://funpay.com/users/{first_id}-{last_id}/"
+
+
+def report_ids(match):
+    """ ID из совпадения USER_ID_PATTERN: один ID или весь участок """
+    first_id = int(match.group(1))
+    return range(first_id, int(match.group(2) or first_id) + 1)
+
+
+class ErrorLedger:
+    """ Ошибки парсинга по ID: статус, число попыток и время последней попытки.
+
+    Ошибки хранятся участками подряд идущих ID с одной записью: entries — первый ID ->
+    (последний, запись, повторы исчерпаны), firsts — первые ID по возрастанию для bisect.
+    Пропуск на миллионы ID занимает один участок; fail и resolve делят участок, а соседние
+    участки с тем же статусом, числом попыток и причиной склеиваются обратно.
+    Те же ID лежат в битовой карте ids: по ней проверяется наличие ID, чекер ищет пропуски,
+    а fail_range находит новые участки без обхода по ID.
+    Отчет errors_funpay.txt дописывается построчно и пересобирается только при сжатии журнала.
+    После attach(writer) строки журнала и отчета пишет задача записи (см. result_writer.py),
+    а сжатие идет через compact_through(writer).
+    """
+
+    def __init__(self, report_path):
+        self.report_path = report_path
+        self.path = os.path.splitext(report_path)[0] + LEDGER_EXTENSION
+        self.entries = {}
+        self.firsts = []
+        self.ids = IdBitmap()
+        self.lines = 0
+        self.journal = None
+        self.report = None
+        self.writer = None
+        # sync() вызывается из потока записи, поэтому закрытие файлов защищено блокировкой
+        self.lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            self._replay()
+            self._open()
+        elif os.path.exists(self.report_path):
+            self._import_report()
+            self.compact()
+        else:
+            self._open()
+
+    def __contains__(self, user_id):
+        return user_id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _find(self, user_id):
+        """ Первый ID участка, в котором лежит user_id, или None """
+        if user_id not in self.ids:
+            return None
+        return self.firsts[bisect.bisect_right(self.firsts, user_id) - 1]
+
+    def get(self, user_id):
+        """ (статус, попытки, время последней попытки, причина) или None """
+        first = self._find(user_id)
+        return None if first is None else self.entries[first][1]
+
+    def is_permanent(self, user_id):
+        first = self._find(user_id)
+        return first is not None and self.entries[first][2]
+
+    def runs(self, first_id=0, last_id=None):
+        """ Участки (первый, последний, запись, повторы исчерпаны), обрезанные по first_id..last_id """
+        firsts = self.firsts
+        start = max(bisect.bisect_right(firsts, first_id) - 1, 0)
+        end = len(firsts) if last_id is None else bisect.bisect_right(firsts, last_id)
+        runs = []
+        for first in firsts[start:end]:
+            last, value, permanent = self.entries[first]
+            if last < first_id:
+                continue
+            if last_id is not None:
+                last = min(last, last_id)
+            runs.append((max(first, first_id), last, value, permanent))
+        return runs
+
+    def pending(self):
+        """ Участки (первый, последний, запись) с ошибками, которые еще нужно повторить """
+        return [(first, last, value) for first, last, value, permanent in self.runs() if not permanent]
+
+    def attach(self, writer):
+        """ Передает запись журнала и отчета в ResultWriter: цикл событий больше не пишет в файлы сам """
+        with self.lock:
+            self._close_files()
+        self.writer = writer
+
+    def _open(self):
+        self.journal = open(self.path, "a", encoding="utf-8")
+        self.report = open(self.report_path, "a", encoding="utf-8-sig")
+
+    def _replay(self):
+        # ResultWriter начинает новый файл с BOM
+        with open(self.path, "r", encoding="utf-8-sig") as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                try:
+                    if fields[0] == "F":
+                        user_id = int(fields[1])
+                        value = (fields[4], int(fields[2]), float(fields[3]), fields[5])
+                        self._put(user_id, user_id, value, self.is_permanent(user_id))
+                    elif fields[0] == "G":
+                        value = (fields[5], int(fields[3]), float(fields[4]), fields[6])
+                        self._put(int(fields[1]), int(fields[2]), value)
+                    elif fields[0] == "R":
+                        self._cut(int(fields[1]), int(fields[1]))
+                    elif fields[0] == "P":
+                        last = fields[2] if len(fields) > 3 else fields[1]
+                        self._give_up(int(fields[1]), int(last))
+                    else:
+                        continue
+                except (IndexError, ValueError):
+                    # Недописанная последняя строка после аварийной остановки
+                    continue
+                self.lines += 1
+
+    def _import_report(self):
+        """ Переносит ошибки из старого errors_funpay.txt, где каждая строка — 'url - причина' (url может быть участком) """
+        timestamp = os.path.getmtime(self.report_path)
+        with open(self.report_path, "r", encoding="utf-8-sig") as f:
+            for line in f:
+                match = USER_ID_PATTERN.search(line)
+                if not match:
+                    continue
+                reason = line.strip().split(" - ", 1)[-1]
+                status = reason.split(" ", 1)[0] if reason[:3].isdigit() else "error"
+                ids = report_ids(match)
+                self._put(ids.start, ids.stop - 1, (status, 1, timestamp, reason))
+
+    def _cut(self, first_id, last_id):
+        """ Убирает ID first_id..last_id из участков; части участков за краями остаются """
+        firsts, entries = self.firsts, self.entries
+        end = bisect.bisect_right(firsts, last_id)
+        start = end
+        while start > 0 and entries[firsts[start - 1]][0] >= first_id:
+            start -= 1
+        kept = []
+        for first in firsts[start:end]:
+            last, value, permanent = entries.pop(first)
+            if first < first_id:
+                entries[first] = (first_id - 1, value, permanent)
+                kept.append(first)
+            if last > last_id:
+                entries[last_id + 1] = (last, value, permanent)
+                kept.append(last_id + 1)
+        firsts[start:end] = kept
+        self.ids.discard_range(first_id, last_id)
+
+    def _put(self, first_id, last_id, value, permanent=False):
+        """ Записывает участок first_id..last_id поверх прежних и склеивает его с такими же соседями """
+        self._cut(first_id, last_id)
+        firsts, entries = self.firsts, self.entries
+        index = bisect.bisect_left(firsts, first_id)
+        if index > 0:
+            first = firsts[index - 1]
+            last, previous, previous_permanent = entries[first]
+            if last == first_id - 1 and self._same(previous, previous_permanent, value, permanent):
+                del entries[first]
+                del firsts[index - 1]
+                index -= 1
+                first_id, value = first, max(previous, value, key=lambda entry: entry[2])
+        if index < len(firsts) and firsts[index] == last_id + 1:
+            last, following, following_permanent = entries[last_id + 1]
+            if self._same(following, following_permanent, value, permanent):
+                del entries[last_id + 1]
+                del firsts[index]
+                last_id, value = last, max(following, value, key=lambda entry: entry[2])
+        entries[first_id] = (last_id, value, permanent)
+        firsts.insert(index, first_id)
+        self.ids.add_range(first_id, last_id)
+
+    @staticmethod
+    def _same(value, permanent, other, other_permanent):
+        """ Участки склеиваются при том же статусе, числе попыток и причине; время берется последнее """
+        return permanent == other_permanent and value[:2] == other[:2] and value[3] == other[3]
+
+    def _give_up(self, first_id, last_id):
+        """ Отмечает исчерпанными повторы для ID first_id..last_id из журнала, возвращает отмеченные участки """
+        changed = [(first, last, value) for first, last, value, permanent in self.runs(first_id, last_id) if not permanent]
+        for first, last, value in changed:
+            self._put(first, last, value, True)
+        return changed
+
+    def _append(self, line, report_line=None):
+        self.lines += line.count("\n")
+        if self.writer is not None:
+            self.writer.write(self.path, line)
+            if report_line is not None:
+                self.writer.write(self.report_path, report_line)
+            return
+        self.journal.write(line)
+        self.journal.flush()
+        if report_line is not None:
+            self.report.write(report_line)
+            self.report.flush()
+
+    def fail(self, user_id, status, reason):
+        """ Записывает неудачную попытку, возвращает число попыток по этому ID """
+        reason = " ".join(str(reason).split())
+        previous = self.get(user_id)
+        attempts = previous[1] + 1 if previous is not None else 1
+        timestamp = time.time()
+        self._put(user_id, user_id, (status, attempts, timestamp, reason), self.is_permanent(user_id))
+        self._append(
+            f"F\t{user_id}\t{attempts}\t{timestamp:.3f}\t{status}\t{reason}\n",
+            f"https://funpay.com/users/{user_id}/ - {reason}\n",
+        )
+        return attempts
+
+    def fail_range(self, first_id, last_id, status, reason):
+        """ Первая неудачная попытка для ID first_id..last_id, которых еще нет в журнале.
+        На каждый непрерывный участок новых ID пишется одна строка в журнал и одна в отчет.
+        Возвращает записанные участки (первый, последний) """
+        reason = " ".join(str(reason).split())
+        value = (status, 1, time.time(), reason)
+        # Участки ищутся по карте ids: занятые и пустые байты пропускаются целиком
+        added = list(self.ids.missing_ranges(first_id, last_id))
+        for first, last in added:
+            self._put(first, last, value)
+            self._append(self._journal_lines(first, last, value), f"{report_url(first, last)} - {reason}\n")
+        return added
+
+    def merge(self, first_id, last_id, value, permanent=False):
+        """ Переносит участок из другого журнала (например, журнала диапазона) с его записью как есть """
+        self._put(first_id, last_id, value, permanent)
+        self._append(self._journal_lines(first_id, last_id, value, permanent), f"{report_url(first_id, last_id)} - {value[3]}\n")
+
+    def resolve(self, user_id):
+        """ Снимает ошибку с ID, если она была """
+        if user_id not in self.ids:
+            return False
+        self._cut(user_id, user_id)
+        self._append(f"R\t{user_id}\t{time.time():.3f}\n")
+        return True
+
+    def give_up(self, first_id, last_id=None):
+        """ Помечает ID first_id..last_id (по умолчанию только first_id) как окончательно отсутствующие:
+        повторов по ним больше не будет. Возвращает число отмеченных ID """
+        changed = self._give_up(first_id, first_id if last_id is None else last_id)
+        timestamp = time.time()
+        for first, last, value in changed:
+            if first == last:
+                self._append(f"P\t{first}\t{timestamp:.3f}\n")
+            else:
+                self._append(f"P\t{first}\t{last}\t{timestamp:.3f}\n")
+        return sum(last - first + 1 for first, last, value in changed)
+
+    def sync(self):
+        """ fsync журнала и отчета; строки уже сброшены в ОС при записи """
+        with self.lock:
+            for f in (self.journal, self.report):
+                if f is not None:
+                    os.fsync(f.fileno())
+
+    def needs_compact(self):
+        return self.lines >= COMPACT_MIN_LINES and self.lines > COMPACT_RATIO * len(self.entries)
+
+    def compact(self):
+        """ Переписывает журнал и отчет только с живыми участками """
+        with self.lock:
+            self._close_files()
+            self.lines = self._rewrite(self.entries)
+            self._open()
+
+    async def compact_through(self, writer):
+        """ compact для журнала, который пишет writer: снимок участков берется на цикле событий
+        в момент постановки в очередь, а файлы переписываются в потоке внутри writer.exclusive.
+        Строки, поставленные позже, допишутся уже в новые файлы """
+        lines = self.lines
+        written = await writer.exclusive(self._rewrite, dict(self.entries))
+        self.lines += written - lines
+
+    @staticmethod
+    def _journal_lines(first, last, value, permanent=False):
+        """ Строки журнала для участка: F или G и, если повторы исчерпаны, P """
+        status, attempts, timestamp, reason = value
+        if first == last:
+            lines = f"F\t{first}\t{attempts}\t{timestamp:.3f}\t{status}\t{reason}\n"
+            return lines + f"P\t{first}\t{timestamp:.3f}\n" if permanent else lines
+        lines = f"G\t{first}\t{last}\t{attempts}\t{timestamp:.3f}\t{status}\t{reason}\n"
+        return lines + f"P\t{first}\t{last}\t{timestamp:.3f}\n" if permanent else lines
+
+    def _rewrite(self, entries):
+        """ Пишет файлы по снимку участков, возвращает число строк в новом журнале """
+        runs = sorted((first, last, value, permanent) for first, (last, value, permanent) in entries.items())
+
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for first, last, value, permanent in runs:
+                f.write(self._journal_lines(first, last, value, permanent))
+            f.flush()
+            os.fsync(f.fileno())
+
+        temp_report = self.report_path + ".tmp"
+        with open(temp_report, "w", encoding="utf-8-sig") as f:
+            for first, last, value, permanent in runs:
+                f.write(f"{report_url(first, last)} - {value[3]}\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(temp_path, self.path)
+        os.replace(temp_report, self.report_path)
+        return len(runs) + sum(permanent for first, last, value, permanent in runs)
+
+    def close(self):
+        with self.lock:
+            self._close_files()
+
+    def _close_files(self):
+        for f in (self.journal, self.report):
+            if f is not None:
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+        self.journal = self.report = None
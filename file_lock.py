@@ -0,0 +1,48 @@
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# Блокировка лежит рядом с файлом: users_funpay.txt -> users_funpay.txt.lock
+LOCK_SUFFIX = ".lock"
+
+
+class WriterLock:
+    """ Межпроцессная блокировка файла результатов: писать в него (дописывать или заменять)
+    может только процесс, который держит блокировку. Парсер и чекер из командной строки
+    берут ее на все время работы, поэтому замена файла не может пройти мимо чужого открытого дескриптора.
+
+    Блокировка — flock на POSIX и msvcrt.locking на Windows: ОС снимает ее сама,
+    если процесс упал, поэтому файл .lock не удаляется и устаревшим не бывает.
+    """
+
+    def __init__(self, path):
+        self.path = path + LOCK_SUFFIX
+        self.file = None
+
+    def acquire(self):
+        """ Берет блокировку без ожидания; False, если ее держит другой процесс """
+        f = open(self.path, "a+b")
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            return False
+        self.file = f
+        return True
+
+    def release(self):
+        if self.file is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.file.close()
+        self.file = None
@@ -0,0 +1,173 @@
+""" Локальный стенд вместо funpay.com для проверки и бенчмарка parser.py.
+
+Запуск: python funpay_stub.py [--port 8765] [--last-id 100000] [--latency-ms 50] [--not-found-rate 0.1]
+        [--max-rps 500] [--rate-limit-rate 0.001] [--truncate-rate 0.01] [--generation 1 --rename-rate 0.05]
+
+Отдает /users/<id>/ со страницей, в которой ник стоит в <span class="mr4">. Какие ID отвечают 404,
+зависит только от ID и --seed, поэтому бенчмарк может проверить результат без обращения к стенду.
+429 (с Retry-After) отдается сверх --max-rps запросов в секунду и еще случайно с долей
+--rate-limit-rate; оборванные тела тоже выпадают случайно. В поколении --generation > 0 доля
+--rename-rate ID отдает другой ник. Страница несет ETag и на совпавший If-None-Match отвечает 304.
+"""
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+from aiohttp import web
+
+STUB_PORT = 8765
+
+# Примерный размер страницы профиля и место ника в ней
+PAGE_SIZE = 60 * 1024
+HEAD_SIZE = 4 * 1024
+
+
+def expected_username(user_id):
+    """ Ник, который стенд отдает для ID; каждый третий — кириллицей """
+    return f"Игрок_{user_id}" if user_id % 3 == 0 else f"user_{user_id}"
+
+
+def stable_fraction(*parts):
+    """ Число из [0, 1), зависящее только от аргументов """
+    digest = hashlib.blake2b(":".join(map(str, parts)).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2 ** 64
+
+
+def is_missing(user_id, not_found_rate, seed=0):
+    """ Отвечает ли стенд 404 для ID """
+    return stable_fraction(seed, user_id) < not_found_rate
+
+
+def is_renamed(user_id, generation, rename_rate, seed=0):
+    """ Сменил ли ID ник в поколении generation """
+    return generation > 0 and stable_fraction(seed, "rename", generation, user_id) < rename_rate
+
+
+def current_username(user_id, generation=0, rename_rate=0.0, seed=0):
+    if is_renamed(user_id, generation, rename_rate, seed):
+        return f"{expected_username(user_id)}_v{generation}"
+    return expected_username(user_id)
+
+
+def render_page(username, page_size=PAGE_SIZE):
+    head = "<!DOCTYPE html><html><head><title>FunPay</title></head><body>".ljust(HEAD_SIZE, " ")
+    profile = f'<div class="profile"><span class="mr4">{username}</span></div>'
+    tail = "<div>" + "x" * max(0, page_size - HEAD_SIZE - len(profile) - 20) + "</div></body></html>"
+    return (head + profile + tail).encode("utf-8")
+
+
+class FunPayStub:
+    def __init__(self, first_id=1, last_id=100000, latency_ms=50, jitter_ms=20, not_found_rate=0.1,
+                 max_rps=0, rate_limit_rate=0.0, retry_after=1, truncate_rate=0.0, page_size=PAGE_SIZE, seed=0,
+                 generation=0, rename_rate=0.0):
+        self.first_id = first_id
+        self.last_id = last_id
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.not_found_rate = not_found_rate
+        self.max_rps = max_rps
+        self.tokens = float(max_rps)
+        self.refilled = time.monotonic()
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.truncate_rate = truncate_rate
+        self.page_size = page_size
+        self.seed = seed
+        self.generation = generation
+        self.rename_rate = rename_rate
+        self.rng = random.Random(seed)
+        self.stats = {"requests": 0, "200": 0, "304": 0, "404": 0, "429": 0, "truncated": 0}
+
+    def take_token(self):
+        """ Ведро токенов на max_rps запросов в секунду; без лимита всегда True """
+        if not self.max_rps:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.max_rps, self.tokens + (now - self.refilled) * self.max_rps)
+        self.refilled = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def exists(self, user_id):
+        return self.first_id <= user_id <= self.last_id and not is_missing(user_id, self.not_found_rate, self.seed)
+
+    async def handle_user(self, request):
+        self.stats["requests"] += 1
+        if not self.take_token() or self.rng.random() < self.rate_limit_rate:
+            self.stats["429"] += 1
+            return web.Response(status=429, headers={"Retry-After": str(self.retry_after)})
+
+        delay = max(0.0, self.latency_ms + self.rng.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+        await asyncio.sleep(delay)
+
+        try:
+            user_id = int(request.match_info["user_id"])
+        except ValueError:
+            user_id = -1
+        if not self.exists(user_id):
+            self.stats["404"] += 1
+            return web.Response(status=404, text="Not Found")
+
+        username = current_username(user_id, self.generation, self.rename_rate, self.seed)
+        etag = '"' + hashlib.blake2b(username.encode(), digest_size=8).hexdigest() + '"'
+        if request.headers.get("If-None-Match") == etag:
+            self.stats["304"] += 1
+            return web.Response(status=304, headers={"ETag": etag})
+
+        body = render_page(username, self.page_size)
+        if self.rng.random() < self.truncate_rate:
+            # Заявляем полную длину, отдаем часть до ника и рвем соединение
+            self.stats["truncated"] += 1
+            response = web.StreamResponse(headers={"Content-Type": "text/html; charset=utf-8", "ETag": etag})
+            response.content_length = len(body)
+            await response.prepare(request)
+            await response.write(body[:HEAD_SIZE // 2])
+            request.transport.close()
+            return response
+
+        self.stats["200"] += 1
+        return web.Response(body=body, content_type="text/html", charset="utf-8", headers={"ETag": etag})
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats)
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get("/users/{user_id}/", self.handle_user)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный стенд профилей FunPay")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=STUB_PORT)
+    parser.add_argument("--first-id", type=int, default=1)
+    parser.add_argument("--last-id", type=int, default=100000)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--not-found-rate", type=float, default=0.1)
+    parser.add_argument("--max-rps", type=float, default=0, help="лимит запросов в секунду, 0 — без лимита")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--truncate-rate", type=float, default=0.0)
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--generation", type=int, default=0, help="поколение ников; в каждом свои переименования")
+    parser.add_argument("--rename-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    stub = FunPayStub(
+        args.first_id, args.last_id, args.latency_ms, args.jitter_ms, args.not_found_rate,
+        args.max_rps, args.rate_limit_rate, args.retry_after, args.truncate_rate, args.page_size, args.seed,
+        args.generation, args.rename_rate,
+    )
+    print(f"[ℹ] Стенд FunPay на http://{args.host}:{args.port}/users/<id>/, ID {args.first_id}-{args.last_id}")
+    web.run_app(stub.make_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
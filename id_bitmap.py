@@ -0,0 +1,187 @@
+import os
+import re
+import struct
+
+# Заголовок файла битовой карты: сигнатура, версия, число ID, длина карты в байтах,
+# смещение и inode файла с данными, по которым карта построена
+BITMAP_MAGIC = b"FPBM"
+BITMAP_VERSION = 1
+BITMAP_HEADER = struct.Struct("<4sHQQQQ")
+
+# Байты, в которых заняты все 8 ID
+FULL_BYTES = re.compile(rb"\xff*")
+EMPTY_BYTES = re.compile(rb"\x00*")
+
+
+class IdBitmap:
+    """ Множество неотрицательных ID в виде плотной битовой карты: 1 МБ на ~8 млн ID """
+
+    def __init__(self, bits=None, count=None):
+        self.bits = bits if bits is not None else bytearray()
+        self.count = count if count is not None else sum(bin(byte).count("1") for byte in self.bits)
+
+    def _grow(self, index):
+        if index >= len(self.bits):
+            self.bits.extend(bytes(max(index + 1, len(self.bits) + len(self.bits) // 2) - len(self.bits)))
+
+    def add(self, user_id):
+        index = user_id >> 3
+        mask = 1 << (user_id & 7)
+        self._grow(index)
+        if not self.bits[index] & mask:
+            self.bits[index] |= mask
+            self.count += 1
+
+    def add_range(self, first, last):
+        """ Добавляет ID first..last: крайние байты по маске, целые байты между ними одним срезом """
+        if last < first:
+            return
+        head, tail = first >> 3, last >> 3
+        self._grow(tail)
+        bits = self.bits
+        if head == tail:
+            mask = ((1 << (last - first + 1)) - 1) << (first & 7)
+            self.count += (mask & ~bits[head]).bit_count()
+            bits[head] |= mask
+            return
+        head_mask = (0xFF << (first & 7)) & 0xFF
+        tail_mask = (1 << ((last & 7) + 1)) - 1
+        middle = bits[head + 1:tail]
+        self.count += (
+            (head_mask & ~bits[head]).bit_count()
+            + (tail_mask & ~bits[tail]).bit_count()
+            + 8 * len(middle) - int.from_bytes(middle, "little").bit_count()
+        )
+        bits[head] |= head_mask
+        bits[tail] |= tail_mask
+        bits[head + 1:tail] = b"\xff" * len(middle)
+
+    def discard_range(self, first, last):
+        """ Убирает ID first..last так же, как add_range их добавляет """
+        last = min(last, (len(self.bits) << 3) - 1)
+        if last < first:
+            return
+        head, tail = first >> 3, last >> 3
+        bits = self.bits
+        if head == tail:
+            mask = ((1 << (last - first + 1)) - 1) << (first & 7)
+            self.count -= (mask & bits[head]).bit_count()
+            bits[head] &= ~mask & 0xFF
+            return
+        head_mask = (0xFF << (first & 7)) & 0xFF
+        tail_mask = (1 << ((last & 7) + 1)) - 1
+        middle = bits[head + 1:tail]
+        self.count -= (
+            (head_mask & bits[head]).bit_count()
+            + (tail_mask & bits[tail]).bit_count()
+            + int.from_bytes(middle, "little").bit_count()
+        )
+        bits[head] &= ~head_mask & 0xFF
+        bits[tail] &= ~tail_mask & 0xFF
+        bits[head + 1:tail] = bytes(len(middle))
+
+    def discard(self, user_id):
+        index = user_id >> 3
+        mask = 1 << (user_id & 7)
+        if 0 <= index < len(self.bits) and self.bits[index] & mask:
+            self.bits[index] &= ~mask & 0xFF
+            self.count -= 1
+
+    def update(self, user_ids):
+        for user_id in user_ids:
+            self.add(user_id)
+
+    def __contains__(self, user_id):
+        index = user_id >> 3
+        return 0 <= index < len(self.bits) and bool(self.bits[index] & (1 << (user_id & 7)))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        bits = self.bits
+        for index, byte in enumerate(bits):
+            if byte:
+                base = index << 3
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield base + bit
+
+    def next_missing(self, start):
+        """ Наименьший ID >= start, которого нет в карте; заполненные байты пропускаются целиком """
+        user_id = max(start, 0)
+        bits = self.bits
+        while user_id in self:
+            if user_id & 7 == 0:
+                end = FULL_BYTES.match(bits, user_id >> 3).end()
+                if end > user_id >> 3:
+                    user_id = end << 3
+                    continue
+            user_id += 1
+        return user_id
+
+    def next_present(self, start):
+        """ Наименьший ID >= start, который есть в карте, или None; пустые байты пропускаются целиком """
+        user_id = max(start, 0)
+        bits = self.bits
+        limit = len(bits) << 3
+        while user_id < limit:
+            if user_id & 7 == 0:
+                end = EMPTY_BYTES.match(bits, user_id >> 3).end()
+                if end > user_id >> 3:
+                    user_id = end << 3
+                    continue
+            if user_id in self:
+                return user_id
+            user_id += 1
+        return None
+
+    def missing_ranges(self, first, last):
+        """ Участки (первый, последний) ID из first..last, которых нет в карте """
+        first = self.next_missing(first)
+        while first <= last:
+            present = self.next_present(first)
+            end = last if present is None else min(present - 1, last)
+            yield first, end
+            first = self.next_missing(end + 1)
+
+    def min_id(self):
+        """ Наименьший ID в карте или None для пустой карты """
+        index = len(self.bits) - len(self.bits.lstrip(b"\x00"))
+        if index == len(self.bits):
+            return None
+        byte = self.bits[index]
+        return (index << 3) + (byte & -byte).bit_length() - 1
+
+    def max_id(self):
+        """ Наибольший ID в карте или None для пустой карты """
+        size = len(self.bits.rstrip(b"\x00"))
+        if not size:
+            return None
+        return ((size - 1) << 3) + self.bits[size - 1].bit_length() - 1
+
+    def save(self, path, offset=0, inode=0):
+        """ Атомарно сохраняет карту вместе с позицией в файле данных, до которой она актуальна """
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(BITMAP_HEADER.pack(BITMAP_MAGIC, BITMAP_VERSION, self.count, len(self.bits), offset, inode))
+            f.write(self.bits)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """ Возвращает (карта, смещение, inode) или None, если файла нет или он поврежден """
+        try:
+            with open(path, "rb") as f:
+                header = f.read(BITMAP_HEADER.size)
+                magic, version, count, size, offset, inode = BITMAP_HEADER.unpack(header)
+                if magic != BITMAP_MAGIC or version != BITMAP_VERSION:
+                    return None
+                bits = bytearray(f.read(size))
+        except (FileNotFoundError, struct.error):
+            return None
+        if len(bits) != size:
+            return None
+        return cls(bits, count), offset, inode
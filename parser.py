@@ -2,12 +2,49 @@ import asyncio
 import aiohttp
 import random
 import os
-from checker import clean_and_check_file
+import time
+import argparse
+import multiprocessing
+from collections import deque
+from checker import check_file_in_background
+from result_writer import ResultWriter
+from error_ledger import ErrorLedger, report_url
+from id_bitmap import IdBitmap
+from crawl_frontier import CrawlFrontier, retry_delay
+from adaptive_limiter import AdaptiveLimiter
+from crawl_leases import LeaseTable, LEASE_TTL
+from users_meta import count_records
+from crawl_metrics import CrawlMetrics, METRICS_PORT
+from refresh_store import RefreshStore
+from file_lock import WriterLock
 
 START_ID = 1
-MAX_CONCURRENT_REQUESTS = 40
+# Откуда брать профили; для локального стенда (см. funpay_stub.py) задается через --base-url
+BASE_URL = "https://funpay.com"
+# Верхняя граница одновременных запросов; рабочее число подбирает AdaptiveLimiter
+MAX_CONCURRENT_REQUESTS = 100
 OUTPUT_FILE = "users_funpay.txt"
 ERROR_FILE = "errors_funpay.txt"
+PROCESSED_BITMAP_FILE = "users_funpay.txt.bitmap"
+CHECKPOINT_FILE = "users_funpay.txt.checkpoint"
+
+# Как часто сохранять чекпоинт обхода (в секундах)
+CHECKPOINT_INTERVAL = 30
+
+# Режим нескольких процессов: каждый диапазон пишется в свой файл в SHARD_DIR,
+# обойденные диапазоны раз в MERGE_INTERVAL секунд переносятся в OUTPUT_FILE
+SHARD_DIR = "shards"
+MERGE_INTERVAL = 30
+
+# Режим обновления (--refresh): ID обходятся от давно проверенных к недавним,
+# а проверенные позже, чем REFRESH_MIN_AGE секунд назад, пропускаются
+REFRESH_MIN_AGE = 7 * 24 * 60 * 60
+REFRESH_PAGE_SIZE = 1000
+
+# Ник лежит в начале страницы: читаем ее кусками до закрывающего тега
+USERNAME_START = b'<span class="mr4">'
+USERNAME_END = b"</span>"
+STREAM_CHUNK_SIZE = 16 * 1024
 
 USER_AGENTS = [
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36",
@@ -19,99 +56,249 @@ USER_AGENTS = [
 PROXIES = [] #Вставьте сюда свои прокси (если есть)
 
 
-processed_ids = set()
-error_ids = set()
+# Обработанные ID — битовая карта по всему пространству ID (см. id_bitmap.py)
+processed_ids = IdBitmap()
+
+# Ошибки по ID со статусом и числом попыток (см. error_ledger.py)
+ledger = None
 
-# Ограничение на размер кэша
-MAX_CACHE_SIZE = 1000
+# После стольких неудачных попыток ID считается окончательно отсутствующим;
+# 404 означает удаленный или несуществующий профиль, поэтому для него лимит меньше
+MAX_RETRY_ATTEMPTS = 8
+NOT_FOUND_RETRY_ATTEMPTS = 3
 
-# Ограничение на размер очереди
+# Сколько ID новых пропусков ставить на повтор, прежде чем отпустить цикл событий
+RETRY_SCHEDULE_BATCH = 10000
+
+# Ограничение на размер очереди: производитель ждет, пока воркеры не освободят место
 MAX_QUEUE_SIZE = 500
 
-def load_processed_ids():
-    if not os.path.exists(OUTPUT_FILE):
-        return set()
+# Запись результатов идет через отдельную задачу (см. result_writer.py)
+writer = None
 
-    with open(OUTPUT_FILE, "r", encoding="utf-8-sig") as f:
-        return {int(line.split("/")[-2]) for line in f if line.strip()}
+base_url = BASE_URL
 
-def load_error_ids():
-    if not os.path.exists(ERROR_FILE):
-        return set()
+# Куда пишутся найденные ники: OUTPUT_FILE или файл диапазона в режиме нескольких процессов
+results_file = OUTPUT_FILE
 
-    with open(ERROR_FILE, "r", encoding="utf-8-sig") as f:
-        return {int(line.split("/")[-2]) for line in f if line.strip()}
+# Следующий новый ID, ID в работе и ID, ждущие повтора (см. crawl_frontier.py)
+frontier = None
+checkpoint_lock = asyncio.Lock()
 
-def remove_error_id(user_id):
-    if not os.path.exists(ERROR_FILE):
-        return
+# Число одновременных запросов по ответам сервера (см. adaptive_limiter.py)
+limiter = None
 
-    with open(ERROR_FILE, "r", encoding="utf-8-sig") as f:
-        lines = f.readlines()
+# get_username возвращает это значение, если ID нужно запросить позже
+RATE_LIMITED = object()
 
-    with open(ERROR_FILE, "w", encoding="utf-8-sig") as f:
-        for line in lines:
-            if line.strip() and str(user_id) not in line:
-                f.write(line)
+# Счетчики и гистограммы обхода (см. crawl_metrics.py)
+metrics = CrawlMetrics()
 
-def clear_cache_if_needed():
-    if len(processed_ids) > MAX_CACHE_SIZE:
-        processed_ids.clear()
-        print("[ℹ] Очищен кэш processed_ids.")
-    if len(error_ids) > MAX_CACHE_SIZE:
-        error_ids.clear()
-        print("[ℹ] Очищен кэш error_ids.")
+# Печатать ли каждого найденного пользователя; по умолчанию только сводка раз в SUMMARY_INTERVAL
+print_found = False
+
+def load_processed_ids(verify=False):
+    """ Берет сохраненную карту ID и дочитывает только строки, дописанные после ее сохранения.
+    Возвращает (карта, была ли использована сохраненная карта); verify=True перечитывает весь файл """
+    processed = IdBitmap()
+    if not os.path.exists(OUTPUT_FILE):
+        return processed, False
+
+    offset = 0
+    stat = os.stat(OUTPUT_FILE)
+    saved = None if verify else IdBitmap.load(PROCESSED_BITMAP_FILE)
+    with open(OUTPUT_FILE, "rb") as f:
+        if saved is not None:
+            bitmap, saved_offset, inode = saved
+            if inode == stat.st_ino and 0 < saved_offset <= stat.st_size:
+                f.seek(saved_offset - 1)
+                if f.read(1) == b"\n":
+                    processed, offset = bitmap, saved_offset
+        f.seek(offset)
+        read_ids(f, processed)
+    return processed, offset > 0
+
+def read_ids(f, processed):
+    """ Добавляет в карту ID из строк бинарного файла, возвращает число добавленных """
+    added = 0
+    for line in f:
+        try:
+            user_id = int(line.split(b"/", 5)[4])
+        except (IndexError, ValueError):
+            continue
+        if user_id not in processed:
+            processed.add(user_id)
+            added += 1
+    return added
+
+def load_frontier(resumed):
+    """ Берет сохраненный чекпоинт, если он построен по той же карте ID, иначе строит границу заново """
+    if resumed:
+        saved = CrawlFrontier.load(CHECKPOINT_FILE)
+        if saved is not None:
+            checkpoint, offset, inode = saved
+            stat = os.stat(OUTPUT_FILE)
+            if inode == stat.st_ino and offset <= stat.st_size:
+                schedule_ledger_retries(checkpoint)
+                return checkpoint, True
+    return rebuild_frontier(), False
+
+def rebuild_frontier():
+    """ Граница по файлу результатов: новые ID идут после наибольшего найденного,
+    пропуски ниже него находит чекер, ID из журнала ошибок идут на повтор """
+    last_id = processed_ids.max_id()
+    next_id = START_ID if last_id is None else max(START_ID, last_id + 1)
+    rebuilt = CrawlFrontier(next_id)
+    schedule_ledger_retries(rebuilt)
+    return rebuilt
+
+def schedule_retry(target, first_id, last_id=None):
+    """ Назначает повтор ID first_id..last_id (по умолчанию только first_id) по числу неудачных попыток
+    из журнала или сдается, если они исчерпаны. Участок должен лежать в одном участке журнала;
+    возвращает число поставленных на повтор ID """
+    if last_id is None:
+        last_id = first_id
+    status, attempts, timestamp, reason = ledger.get(first_id)
+    limit = NOT_FOUND_RETRY_ATTEMPTS if status == "404" else MAX_RETRY_ATTEMPTS
+    if attempts >= limit:
+        given_up = ledger.give_up(first_id, last_id)
+        metrics.inc("given_up_total", value=given_up)
+        print(f"[✖] {report_url(first_id, last_id)} отмечен как отсутствующий после {attempts} попыток ({reason}).")
+        return 0
+    return target.schedule_retry(first_id, timestamp + retry_delay(attempts), last_id)
+
+def schedule_ledger_retries(target):
+    """ Ставит на повтор участки журнала ошибок, кроме ID, которые уже есть в файле результатов """
+    scheduled = 0
+    for run_first, run_last, value in ledger.pending():
+        for first, last in list(processed_ids.missing_ranges(run_first, run_last)):
+            scheduled += schedule_retry(target, first, last)
+    return scheduled
+
+async def schedule_gap_retries(gaps):
+    """ Ставит на повтор участки, которые чекер только что записал в журнал. Обходятся только новые участки,
+    а не весь журнал, и каждые RETRY_SCHEDULE_BATCH участков цикл событий отпускается """
+    scheduled = 0
+    batch = 0
+    for gap_first, gap_last in gaps:
+        for first, last, value, permanent in ledger.runs(gap_first, gap_last):
+            if not permanent:
+                scheduled += schedule_retry(frontier, first, last)
+            batch += 1
+            if batch >= RETRY_SCHEDULE_BATCH:
+                batch = 0
+                await asyncio.sleep(0)
+    return scheduled
+
+def retries_outside_ledger():
+    """ Участки ждущих повтора ID, которых нет в журнале ошибок, — повторы после 429 """
+    return [gap for first, last in frontier.retry_ranges() for gap in ledger.ids.missing_ranges(first, last)]
+
+def save_processed_ids(bitmap=None, stat=None):
+    """ stat — состояние файла результатов, которому соответствует bitmap; без него берется текущее """
+    if stat is None and os.path.exists(OUTPUT_FILE):
+        stat = os.stat(OUTPUT_FILE)
+    if stat is not None:
+        (bitmap or processed_ids).save(PROCESSED_BITMAP_FILE, stat.st_size, stat.st_ino)
+    return stat
+
+async def save_checkpoint():
+    """ Сохраняет карту ID и границу обхода согласованно.
+
+    Состояние снимается до flush, а смещение в файле берется ровно в точке flush: в файле до него
+    только строки, поставленные до снимка, а более поздние дочитаются из хвоста при запуске.
+    """
+    async with checkpoint_lock:
+        bitmap = IdBitmap(bytearray(processed_ids.bits), processed_ids.count)
+        snapshot = frontier.snapshot()
+        stat = await writer.flush(OUTPUT_FILE)
+        if stat is not None:
+            await asyncio.to_thread(save_processed_ids, bitmap, stat)
+            await asyncio.to_thread(snapshot.save, CHECKPOINT_FILE, stat.st_size, stat.st_ino)
+
+async def run_checkpointer():
+    while True:
+        await asyncio.sleep(CHECKPOINT_INTERVAL)
+        # Отмена задачи при остановке не должна обрывать запись на середине
+        await asyncio.shield(save_checkpoint())
+
+async def read_username(response):
+    """ Читает тело кусками, пока не встретится ник, и сразу закрывает соединение.
+    Возвращает ник или None, если маркера на странице нет """
+    buffer = bytearray()
+    start = -1
+    try:
+        async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+            buffer += chunk
+            if start == -1:
+                start = buffer.find(USERNAME_START)
+                if start == -1:
+                    # Маркер может быть разрезан между кусками: хвост оставляем
+                    del buffer[:-(len(USERNAME_START) - 1)]
+                    continue
+                del buffer[:start + len(USERNAME_START)]
+            end = buffer.find(USERNAME_END)
+            if end != -1:
+                return buffer[:end].decode(response.charset or "utf-8", errors="replace").strip()
+        return None
+    finally:
+        # Недочитанное тело не дает вернуть соединение в пул, поэтому оно закрывается
+        if not response.content.at_eof():
+            response.close()
+
+def handle_rate_limit(response):
+    """ 429: общая пауза по Retry-After и снижение лимита запросов """
+    try:
+        retry_after = int(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        retry_after = random.randint(10, 30)
+    limiter.on_overload(retry_after)
+    print(f"[⏳] 429 Too Many Requests. Пауза {retry_after} секунд, лимит запросов {int(limiter.limit)}.")
 
 async def get_username(session, user_id):
-    url = f"https://funpay.com/users/{user_id}/"
+    url = f"{base_url}/users/{user_id}/"
     headers = {"User-Agent": random.choice(USER_AGENTS)}
     proxy = random.choice(PROXIES) if PROXIES else None
 
+    started = time.monotonic()
     try:
         async with session.get(url, headers=headers, proxy=proxy, timeout=10) as response:
+            latency = time.monotonic() - started
+            metrics.observe("request_seconds", latency)
+            metrics.inc("requests_total", str(response.status))
+            if response.status != 429:
+                limiter.on_response(latency)
             if response.status == 200:
-                html = await response.text()
-                username_start = html.find('<span class="mr4">')
-                if username_start != -1:
-                    username_end = html.find("</span>", username_start)
-                    username = html[username_start + 18:username_end].strip()
-
-                    print(f"[✔] Найден: {username} - {user_id}")
+                username = await read_username(response)
+                if username is not None:
+                    metrics.inc("found_total")
+                    if print_found:
+                        print(f"[✔] Найден: {username} - {user_id}")
 
                     if user_id not in processed_ids:
-                        with open(OUTPUT_FILE, "a", encoding="utf-8-sig") as f:
-                            f.write(f"https://funpay.com/users/{user_id}/ - {username}\n")
-                            f.flush()
-                            os.fsync(f.fileno())
-
+                        writer.write(results_file, f"https://funpay.com/users/{user_id}/ - {username}\n")
                         processed_ids.add(user_id)
 
-                        if user_id in error_ids:
-                            remove_error_id(user_id)
-                            error_ids.discard(user_id)
+                        ledger.resolve(user_id)
                     return username
+                metrics.inc("no_username_total")
+                ledger.fail(user_id, "200", "Ник не найден на странице")
+                return None
             elif response.status == 429:
-                retry_after = int(response.headers.get("Retry-After", random.randint(10, 30)))
-                print(f"[⏳] 429 Too Many Requests. Жду {retry_after} секунд...")
-                await asyncio.sleep(retry_after)
-                return await get_username(session, user_id)
+                handle_rate_limit(response)
+                return RATE_LIMITED
             else:
-                error_message = f"{url} - {response.status} {response.reason}"
-                with open(ERROR_FILE, "a", encoding="utf-8-sig") as f:
-                    f.write(f"{error_message}\n")
-                    f.flush()
-                    os.fsync(f.fileno())
-
-                error_ids.add(user_id)
+                ledger.fail(user_id, str(response.status), f"{response.status} {response.reason}")
                 return None
+    except asyncio.TimeoutError:
+        metrics.inc("requests_total", "timeout")
+        limiter.on_overload()
+        ledger.fail(user_id, "timeout", "Ошибка: таймаут")
+        print(f"[⚠] Таймаут при обработке ID {user_id} (прокси: {proxy}), лимит запросов {int(limiter.limit)}.")
+        return None
     except Exception as e:
-        error_message = f"{url} - Ошибка: {str(e)}"
-        with open(ERROR_FILE, "a", encoding="utf-8-sig") as f:
-            f.write(f"{error_message}\n")
-            f.flush()
-            os.fsync(f.fileno())
-
-        error_ids.add(user_id)
+        metrics.inc("requests_total", "error")
+        ledger.fail(user_id, "error", f"Ошибка: {str(e)}")
         print(f"[⚠] Ошибка при обработке ID {user_id} (прокси: {proxy}): {e}")
         return None
 
@@ -120,71 +307,499 @@ async def worker(session, queue):
         user_id = await queue.get()
         if user_id is None:
             break
-        await get_username(session, user_id)
+        async with limiter:
+            result = await get_username(session, user_id)
+        frontier.done(user_id)
+        if result is RATE_LIMITED:
+            # Общую паузу по Retry-After держит limiter, ID можно выдать сразу
+            frontier.schedule_retry(user_id, time.time())
+        elif result is None and not ledger.is_permanent(user_id):
+            schedule_retry(frontier, user_id)
         queue.task_done()
 
-async def run_checker(queue):
+async def produce(queue, end_id=None):
+    """ Кладет в очередь созревшие повторы и новые ID. С end_id возвращается, когда новые ID
+    до end_id кончились и созревших повторов нет; возвращает число выданных ID """
+    issued = 0
     while True:
-        await asyncio.sleep(180)
-        print("\n[ℹ] Запуск чекера для проверки файлов...")
-        clean_and_check_file(OUTPUT_FILE, ERROR_FILE)
-
-        error_ids = load_error_ids()
-        if error_ids:
-            print(f"[ℹ] Найдено {len(error_ids)} ID с ошибками для повторной проверки.")
-            for user_id in error_ids:
-                if user_id not in processed_ids:
-                    await queue.put(user_id)
-                    print(f"[ℹ] Добавлен ID {user_id} с ошибкой для повторной проверки.")
-                    remove_error_id(user_id)
-
+        user_id = frontier.next_retry(time.time())
+        if user_id is None:
+            if end_id is not None and frontier.next_id > end_id:
+                return issued
+            user_id = frontier.advance(processed_ids)
+        elif user_id in processed_ids or user_id in frontier.in_flight or ledger.is_permanent(user_id):
+            continue
+        frontier.issue(user_id)
+        await queue.put(user_id)
+        issued += 1
+
+async def wait_with_writer(*tasks):
+    """ Ждет задачи вместе с задачей записи, возвращает завершившиеся. Если writer упал, воркеры гибнут
+    на первой же строке, а produce вечно ждал бы места в очереди, поэтому поднимается ошибка записи """
+    done, _ = await asyncio.wait([*tasks, writer.task], return_when=asyncio.FIRST_COMPLETED)
+    writer.check()
+    return done
+
+async def stop_workers(queue, workers):
+    """ Останавливает воркеров после текущих ID. Если задача записи упала, воркеры могли умереть,
+    не разобрав очередь, и None в нее не поместится — тогда они отменяются """
+    if writer.task.done():
+        for task in workers:
+            task.cancel()
+    else:
+        for _ in workers:
+            await queue.put(None)
+    await asyncio.gather(*workers, return_exceptions=True)
+
+async def restore_in_flight(queue):
+    """ ID, выданные до остановки, снова идут в очередь первыми """
+    for user_id in sorted(frontier.in_flight):
+        if user_id in processed_ids:
+            frontier.done(user_id)
+        else:
+            await queue.put(user_id)
 
-        clear_cache_if_needed()
+def watch(queue):
+    """ Датчики текущего состояния для /metrics и сводки """
+    metrics.gauge("queue_depth", queue.qsize)
+    metrics.gauge("workers_busy", lambda: limiter.active)
+    metrics.gauge("concurrency_limit", lambda: int(limiter.limit))
+    metrics.gauge("writer_queue", lambda: writer.queue.qsize())
+    if frontier is not None:
+        metrics.gauge("in_flight", lambda: len(frontier.in_flight))
+        metrics.gauge("retries_pending", lambda: len(frontier.waiting))
+
+async def start_metrics(port):
+    """ Сводка раз в SUMMARY_INTERVAL и /metrics, если port не 0. Возвращает (задача сводки, runner) """
+    report_task = asyncio.create_task(metrics.report())
+    runner = None
+    if port:
+        try:
+            runner = await metrics.serve(port=port)
+        except OSError as e:
+            print(f"[⚠] Не удалось открыть порт метрик {port}: {e}")
+    return report_task, runner
 
-async def main():
-    queue = asyncio.Queue()
+async def stop_metrics(report_task, runner):
+    report_task.cancel()
+    if runner is not None:
+        await runner.cleanup()
 
-    global processed_ids, error_ids
-    processed_ids = load_processed_ids()
-    error_ids = load_error_ids()
+async def run_checker():
+    while True:
+        await asyncio.sleep(180)
+        print("\n[ℹ] Запуск чекера для проверки файлов...")
+        # ID в работе и повторы после 429 еще не попали ни в файл, ни в журнал — это не пропуски
+        skip_ids = set(frontier.in_flight)
+        for first, last in retries_outside_ledger():
+            skip_ids.update(range(first, last + 1))
+        replaced, gaps = await check_file_in_background(OUTPUT_FILE, ERROR_FILE, ledger, writer, skip_ids, frontier.next_id)
+        if replaced:
+            # Файл заменен: карта ID и граница обхода должны ссылаться на новый файл
+            await save_checkpoint()
+
+        # Остальные ID журнала уже на повторе: их ставят воркеры при ошибке и rebuild_frontier при запуске
+        scheduled = await schedule_gap_retries(gaps)
+        if scheduled:
+            print(f"[ℹ] Запланировано {scheduled} новых повторов, всего ждут повтора {len(frontier.waiting)} ID.")
+
+        if ledger.needs_compact():
+            await ledger.compact_through(writer)
+            print("[ℹ] Журнал ошибок сжат.")
+
+async def main(verify=False, metrics_port=METRICS_PORT, end_id=None):
+    queue = asyncio.Queue(MAX_QUEUE_SIZE)
+
+    global processed_ids, ledger, writer, frontier, limiter
+    processed_ids, resumed = load_processed_ids(verify)
+    ledger = ErrorLedger(ERROR_FILE)
+    frontier, resumed = load_frontier(resumed)
     print(f"[ℹ] Загружено {len(processed_ids)} обработанных ID.")
-    print(f"[ℹ] Загружено {len(error_ids)} ID с ошибками для повторного парсинга.")
-
-    for user_id in error_ids:
-        if user_id not in processed_ids:
-            await queue.put(user_id)
-
-    user_id = START_ID
-    connector = aiohttp.TCPConnector(ssl=False)
+    print(f"[ℹ] Загружено {len(ledger)} ID с ошибками для повторного парсинга.")
+    if resumed:
+        print(f"[ℹ] Продолжаю с ID {frontier.next_id}: {len(frontier.in_flight)} ID в работе, {len(frontier.waiting)} на повтор.")
+    else:
+        print(f"[ℹ] Чекпоинт построен по {OUTPUT_FILE}, продолжаю с ID {frontier.next_id}.")
+
+    writer = ResultWriter(meta_files=[OUTPUT_FILE], metrics=metrics)
+    ledger.attach(writer)
+    writer.start()
+    if not resumed:
+        await save_checkpoint()
+
+    limiter = AdaptiveLimiter(MAX_CONCURRENT_REQUESTS)
+    connector = aiohttp.TCPConnector(ssl=False, limit=MAX_CONCURRENT_REQUESTS)
     async with aiohttp.ClientSession(connector=connector) as session:
         workers = [asyncio.create_task(worker(session, queue)) for _ in range(MAX_CONCURRENT_REQUESTS)]
-        checker_task = asyncio.create_task(run_checker(queue))
+        checker_task = asyncio.create_task(run_checker())
+        checkpoint_task = asyncio.create_task(run_checkpointer())
+        watch(queue)
+        metrics_tasks = await start_metrics(metrics_port)
 
+        crawl_task = None
         try:
-            while True:
-                if queue.qsize() < MAX_QUEUE_SIZE:
-                    await queue.put(user_id)
-                    user_id += 1
-                    while user_id in processed_ids:
-                        user_id += 1
-                else:
-                    await asyncio.sleep(1) 
+            await restore_in_flight(queue)
+            crawl_task = asyncio.create_task(produce(queue) if end_id is None else crawl_until_done(queue, end_id))
+            await wait_with_writer(crawl_task)
+            crawl_task.result()
+            if end_id is not None:
+                print(f"[✔] Обход до ID {end_id} завершен.")
         except asyncio.CancelledError:
             print("\n[❌] Остановка скрипта (CTRL + C)")
         finally:
-            for _ in workers:
-                await queue.put(None)
-            await asyncio.gather(*workers, return_exceptions=True)
-
-
+            # Чекер останавливается первым: он пишет в журнал и ставит задания в writer
             checker_task.cancel()
             try:
                 await checker_task
             except asyncio.CancelledError:
                 print("\n[ℹ] Чекер остановлен.")
+            except Exception as e:
+                print(f"[❌] Чекер завершился с ошибкой: {e}")
+            checkpoint_task.cancel()
+            if crawl_task is not None:
+                crawl_task.cancel()
+            await stop_metrics(*metrics_tasks)
+            await stop_workers(queue, workers)
+            # Без задачи записи чекпоинт остается прежним: ID после него повторятся при следующем запуске
+            if not writer.task.done():
+                await save_checkpoint()
+                await writer.close()
+            ledger.close()
+
+async def refresh_profile(session, store, row):
+    """ Повторная проверка известного ID условным запросом. Сменившийся ник записывается
+    в known и в историю RefreshStore, OUTPUT_FILE не меняется. False — ответ 429, ID нужно запросить еще раз """
+    user_id, known_username, _, etag, last_modified = row
+    headers = {"User-Agent": random.choice(USER_AGENTS)}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    proxy = random.choice(PROXIES) if PROXIES else None
 
-if __name__ == "__main__":
+    started = time.monotonic()
     try:
-        asyncio.run(main())
+        async with session.get(f"{base_url}/users/{user_id}/", headers=headers, proxy=proxy, timeout=10) as response:
+            latency = time.monotonic() - started
+            metrics.observe("request_seconds", latency)
+            metrics.inc("requests_total", str(response.status))
+            if response.status == 429:
+                handle_rate_limit(response)
+                return False
+            limiter.on_response(latency)
+
+            if response.status == 304:
+                store.mark_checked(user_id, etag, last_modified)
+                metrics.inc("refresh_total", "not_modified")
+            elif response.status == 200:
+                username = await read_username(response)
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+                if username is None:
+                    store.mark_checked(user_id)
+                    metrics.inc("refresh_total", "no_username")
+                elif username != known_username:
+                    store.record_rename(user_id, known_username, username)
+                    store.mark_checked(user_id, etag, last_modified, username)
+                    metrics.inc("refresh_total", "renamed")
+                    if print_found:
+                        print(f"[✎] {user_id}: {known_username} -> {username}")
+                else:
+                    store.mark_checked(user_id, etag, last_modified)
+                    metrics.inc("refresh_total", "unchanged")
+            else:
+                # Удаленный профиль тоже отмечаем проверенным, ник в базе остается прежним
+                store.mark_checked(user_id, etag, last_modified)
+                metrics.inc("refresh_total", str(response.status))
+            return True
+    except asyncio.TimeoutError:
+        metrics.inc("requests_total", "timeout")
+        limiter.on_overload()
+    except Exception as e:
+        metrics.inc("requests_total", "error")
+        print(f"[⚠] Ошибка при обновлении ID {user_id} (прокси: {proxy}): {e}")
+    # Непроверенный ID остается самым старым и попадет в следующий проход
+    return True
+
+async def refresh_worker(session, queue, again, store):
+    while True:
+        row = await queue.get()
+        if row is None:
+            break
+        async with limiter:
+            done = await refresh_profile(session, store, row)
+        if not done:
+            again.append(row)
+        queue.task_done()
+
+async def refresh(limit=None, min_age=REFRESH_MIN_AGE, metrics_port=METRICS_PORT):
+    """ Обходит известные ID от давно проверенных к недавним, не больше limit за запуск """
+    global limiter
+    store = RefreshStore()
+    imported = store.sync_from_output(OUTPUT_FILE)
+    print(f"[ℹ] Известно {store.count()} ID, новых строк из {OUTPUT_FILE}: {imported}.")
+
+    limiter = AdaptiveLimiter(MAX_CONCURRENT_REQUESTS)
+    queue = asyncio.Queue(MAX_QUEUE_SIZE)
+    # ID после 429 возвращаются в очередь раньше следующих по давности
+    again = deque()
+    cutoff = time.time() - min_age
+    issued = 0
+
+    connector = aiohttp.TCPConnector(ssl=False, limit=MAX_CONCURRENT_REQUESTS)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        workers = [asyncio.create_task(refresh_worker(session, queue, again, store)) for _ in range(MAX_CONCURRENT_REQUESTS)]
+        watch(queue)
+        metrics_tasks = await start_metrics(metrics_port)
+        try:
+            after = (-1.0, -1)
+            while limit is None or issued < limit:
+                rows = store.oldest(cutoff, after, REFRESH_PAGE_SIZE)
+                if not rows:
+                    break
+                after = (rows[-1][2], rows[-1][0])
+                for row in rows[:None if limit is None else limit - issued]:
+                    while again:
+                        await queue.put(again.popleft())
+                    await queue.put(row)
+                    issued += 1
+            await queue.join()
+            while again:
+                while again:
+                    await queue.put(again.popleft())
+                await queue.join()
+        except asyncio.CancelledError:
+            print("\n[❌] Остановка обновления (CTRL + C)")
+        finally:
+            await stop_metrics(*metrics_tasks)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers, return_exceptions=True)
+            store.close()
+    print(
+        f"[✔] Проверено {issued} ID: сменили ник {metrics.counter('refresh_total', 'renamed')}, "
+        f"без изменений {metrics.counter('refresh_total', 'unchanged') + metrics.counter('refresh_total', 'not_modified')}."
+    )
+
+def range_file(start_id, suffix=".txt"):
+    return os.path.join(SHARD_DIR, f"range_{start_id}{suffix}")
+
+def range_progress():
+    """ Все ID диапазона меньше этого значения уже в файле диапазона или в его журнале ошибок """
+    waiting = [first for first, last in retries_outside_ledger()]
+    return min([frontier.next_id, *frontier.in_flight, *waiting])
+
+async def renew_lease(leases, owner, start_id):
+    """ Продлевает аренду, пока диапазон обходится; прогресс сохраняется только после flush """
+    while True:
+        await asyncio.sleep(LEASE_TTL / 4)
+        progress = range_progress()
+        await writer.flush()
+        if not leases.renew(start_id, owner, progress):
+            raise RuntimeError(f"аренда диапазона {start_id} потеряна")
+
+async def crawl_range(session, leases, owner, start_id, end_id, next_id):
+    """ Обходит арендованный диапазон; после падения процесса его продолжает другой с next_id """
+    global ledger, writer, frontier, results_file
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    results_file = range_file(start_id)
+    if os.path.exists(results_file):
+        with open(results_file, "rb") as f:
+            read_ids(f, processed_ids)
+    ledger = ErrorLedger(range_file(start_id, ".errors.txt"))
+    frontier = CrawlFrontier(next_id)
+    writer = ResultWriter(metrics=metrics)
+    ledger.attach(writer)
+    writer.start()
+
+    queue = asyncio.Queue(MAX_QUEUE_SIZE)
+    watch(queue)
+    workers = [asyncio.create_task(worker(session, queue)) for _ in range(limiter.max_limit)]
+    lease_task = asyncio.create_task(renew_lease(leases, owner, start_id))
+    crawl_task = asyncio.create_task(crawl_until_done(queue, end_id))
+    completed = False
+    try:
+        done = await wait_with_writer(crawl_task, lease_task)
+        if crawl_task in done:
+            crawl_task.result()
+            completed = True
+        else:
+            print(f"[⚠] {lease_task.exception()}, диапазон брошен.")
+    finally:
+        crawl_task.cancel()
+        lease_task.cancel()
+        await stop_workers(queue, workers)
+        # С упавшей задачей записи прогресс после renew не на диске: аренду заберут после выхода процесса
+        writer_failed = writer.task.done()
+        progress = range_progress()
+        if not writer_failed:
+            await writer.close()
+        ledger.close()
+        if completed:
+            leases.complete(start_id, owner)
+            print(f"[✔] Диапазон {start_id}-{end_id} обойден.")
+        elif not writer_failed:
+            leases.release(start_id, owner, progress)
+
+async def crawl_until_done(queue, end_id):
+    # После join могут созреть повторы после 429; диапазон закрыт, когда выдавать больше нечего
+    while True:
+        issued = await produce(queue, end_id)
+        await queue.join()
+        if not issued:
+            return
+
+async def run_shard(index, shards, first_id, last_id, metrics_port):
+    global processed_ids, limiter
+    metrics.name = f"shard{index}"
+    processed_ids, _ = load_processed_ids()
+    limiter = AdaptiveLimiter(max(1, MAX_CONCURRENT_REQUESTS // shards))
+    leases = LeaseTable()
+    owner = f"shard{index}-{os.getpid()}"
+    connector = aiohttp.TCPConnector(ssl=False, limit=limiter.max_limit)
+    # Каждый процесс отдает свои метрики на следующем порту после общего
+    metrics_tasks = await start_metrics(metrics_port + index + 1 if metrics_port else 0)
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            while True:
+                lease = leases.claim(owner, first_id, last_id)
+                if lease is None:
+                    return
+                await crawl_range(session, leases, owner, *lease)
+    finally:
+        await stop_metrics(*metrics_tasks)
+        leases.close()
+
+def shard_main(index, shards, first_id, last_id, metrics_port, verbose, url):
+    global print_found, base_url
+    print_found = verbose
+    base_url = url
+    try:
+        asyncio.run(run_shard(index, shards, first_id, last_id, metrics_port))
+    except KeyboardInterrupt:
+        pass
+
+def merge_ranges(leases):
+    """ Переносит обойденные диапазоны в OUTPUT_FILE и общий журнал ошибок.
+    Повторный перенос после сбоя безопасен: уже перенесенные ID отсеивает карта processed_ids """
+    merged = 0
+    for start_id, end_id in leases.completed():
+        lines = []
+        path = range_file(start_id)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8-sig") as f:
+                for line in f:
+                    try:
+                        user_id = int(line.split("/", 5)[4])
+                    except (IndexError, ValueError):
+                        continue
+                    if user_id not in processed_ids:
+                        processed_ids.add(user_id)
+                        ledger.resolve(user_id)
+                        lines.append(line if line.endswith("\n") else line + "\n")
+        if lines:
+            with open(OUTPUT_FILE, "a", encoding="utf-8-sig") as f:
+                f.write("".join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+
+        errors_path = range_file(start_id, ".errors.txt")
+        if os.path.exists(range_file(start_id, ".errors.ledger")):
+            range_ledger = ErrorLedger(errors_path)
+            for run_first, run_last, value, permanent in range_ledger.runs():
+                for first, last in list(processed_ids.missing_ranges(run_first, run_last)):
+                    ledger.merge(first, last, value, permanent)
+            range_ledger.close()
+        ledger.sync()
+        save_processed_ids()
+        leases.mark_merged(start_id)
+
+        for suffix in (".txt", ".errors.txt", ".errors.ledger"):
+            if os.path.exists(range_file(start_id, suffix)):
+                os.remove(range_file(start_id, suffix))
+        merged += 1
+    if merged and os.path.exists(OUTPUT_FILE):
+        count_records(OUTPUT_FILE)
+    return merged
+
+def run_sharded(shards, last_id=None, verify=False, metrics_port=METRICS_PORT):
+    """ Запускает shards процессов, раздает им диапазоны через LeaseTable и сливает результаты.
+    Упавший процесс перезапускается, а его аренду забирает первый, кто попросит новый диапазон """
+    global processed_ids, ledger, frontier
+    processed_ids, _ = load_processed_ids(verify)
+    ledger = ErrorLedger(ERROR_FILE)
+    last_found = processed_ids.max_id()
+    first_id = START_ID if last_found is None else max(START_ID, last_found + 1)
+    leases = LeaseTable()
+    print(f"[ℹ] Запускаю {shards} процессов, новые диапазоны начинаются с ID {first_id}.")
+
+    # spawn, а не fork: дочерним процессам не достаются открытые файлы и соединение SQLite
+    context = multiprocessing.get_context("spawn")
+    processes = {}
+    try:
+        while True:
+            for index in range(shards):
+                process = processes.get(index)
+                if process is not None and (process.is_alive() or process.exitcode == 0):
+                    continue
+                if process is not None:
+                    print(f"[⚠] Процесс {index} упал с кодом {process.exitcode}, перезапускаю.")
+                process = context.Process(target=shard_main, args=(index, shards, first_id, last_id, metrics_port, print_found, base_url))
+                process.start()
+                processes[index] = process
+
+            merged = merge_ranges(leases)
+            if merged:
+                print(f"[ℹ] Перенесено диапазонов: {merged}, всего ID: {len(processed_ids)}.")
+            if all(process.exitcode == 0 for process in processes.values()):
+                break
+            time.sleep(MERGE_INTERVAL)
     except KeyboardInterrupt:
-        print("\n[❌] Скрипт остановлен пользователем.")
+        print("\n[❌] Остановка процессов...")
+    finally:
+        for process in processes.values():
+            process.join()
+        merge_ranges(leases)
+        leases.close()
+        # Однопроцессный режим после этого продолжит с границы, построенной по результатам
+        frontier = rebuild_frontier()
+        stat = save_processed_ids()
+        if stat is not None:
+            frontier.save(CHECKPOINT_FILE, stat.st_size, stat.st_ino)
+        ledger.close()
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Парсер пользователей FunPay")
+    arg_parser.add_argument("--verify", action="store_true", help="перечитать весь файл результатов и пересобрать чекпоинт")
+    arg_parser.add_argument("--shards", type=int, default=0, help="число процессов, делящих ID по диапазонам")
+    arg_parser.add_argument("--end-id", type=int, default=None, help="последний ID: обойти до него и остановиться")
+    arg_parser.add_argument("--refresh", action="store_true", help="перепроверить известные ID на смену ника")
+    arg_parser.add_argument("--refresh-limit", type=int, default=None, help="сколько ID перепроверить за запуск")
+    arg_parser.add_argument("--refresh-min-age", type=float, default=REFRESH_MIN_AGE / 86400, help="пропускать ID, проверенные меньше стольких дней назад")
+    arg_parser.add_argument("--base-url", default=BASE_URL, help="адрес сайта, например локального стенда funpay_stub.py")
+    arg_parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="порт /metrics, 0 — не открывать")
+    arg_parser.add_argument("--print-found", action="store_true", help="печатать каждого найденного пользователя")
+    args = arg_parser.parse_args()
+    print_found = args.print_found
+    base_url = args.base_url.rstrip("/")
+    if args.refresh:
+        # Обновление только читает OUTPUT_FILE, поэтому может идти рядом с парсером
+        try:
+            asyncio.run(refresh(args.refresh_limit, args.refresh_min_age * 86400, args.metrics_port))
+        except KeyboardInterrupt:
+            print("\n[❌] Скрипт остановлен пользователем.")
+    else:
+        # Второй процесс, пишущий в OUTPUT_FILE, потерял бы строки при замене файла чекером
+        lock = WriterLock(OUTPUT_FILE)
+        if not lock.acquire():
+            raise SystemExit(f"[❌] В {OUTPUT_FILE} уже пишет другой процесс (парсер или checker.py). Дождитесь его завершения.")
+        try:
+            if args.shards:
+                run_sharded(args.shards, args.end_id, args.verify, args.metrics_port)
+            else:
+                try:
+                    asyncio.run(main(args.verify, args.metrics_port, args.end_id))
+                except KeyboardInterrupt:
+                    print("\n[❌] Скрипт остановлен пользователем.")
+        finally:
+            lock.release()
@@ -0,0 +1,134 @@
+import os
+import time
+import sqlite3
+from users_index import iter_line_blocks, parse_user_line
+
+# База для режима обновления: когда каждый ID проверялся последний раз и история смены ников
+REFRESH_DB_FILE = "users_refresh.db"
+
+# Сколько отметок о проверке копить перед записью в базу
+COMMIT_EVERY = 1000
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS known (
+        id INTEGER PRIMARY KEY,
+        username TEXT NOT NULL,
+        checked REAL NOT NULL DEFAULT 0,
+        etag TEXT,
+        last_modified TEXT
+    );
+    CREATE INDEX IF NOT EXISTS known_checked ON known (checked, id);
+    CREATE TABLE IF NOT EXISTS renames (
+        id INTEGER NOT NULL,
+        old_username TEXT NOT NULL,
+        new_username TEXT NOT NULL,
+        changed REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS renames_id ON renames (id, changed);
+    CREATE TABLE IF NOT EXISTS refresh_meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER
+    );
+"""
+
+
+class RefreshStore:
+    """ Известные ID с временем последней проверки и валидаторами для условных запросов.
+
+    Новые строки users_funpay.txt дочитываются по сохраненному смещению. Смены ника
+    в users_funpay.txt не попадают: актуальный ник хранится в known, а в историю
+    renames пишутся только изменения: (id, старый, новый, время). Поиск бота накладывает
+    renames поверх файла (UsersIndex и users_db.import_users_file через users_index.read_renames).
+    """
+
+    def __init__(self, db_path=REFRESH_DB_FILE):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.pending_checks = []
+        self.pending_renames = []
+
+    def _get_meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM refresh_meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def _set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO refresh_meta (key, value) VALUES (?, ?)", (key, value))
+
+    def sync_from_output(self, path):
+        """ Дочитывает users_funpay.txt с прошлого раза и добавляет новые ID. Ник уже известного ID
+        не трогается: в файле остается ник первого обхода, а смены ника есть только в known """
+        if not os.path.exists(path):
+            return 0
+        stat = os.stat(path)
+        offset = self._get_meta("offset", 0)
+        if self._get_meta("inode") != stat.st_ino or stat.st_size < offset:
+            offset = 0
+
+        imported = 0
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for block in iter_line_blocks(f):
+                rows = []
+                for line in block.decode("utf-8", errors="replace").splitlines():
+                    record = parse_user_line(line)
+                    if record is not None:
+                        rows.append(record)
+                with self.conn:
+                    self.conn.executemany("INSERT INTO known (id, username) VALUES (?, ?) ON CONFLICT (id) DO NOTHING", rows)
+                    offset += len(block)
+                    self._set_meta("offset", offset)
+                    self._set_meta("inode", stat.st_ino)
+                imported += len(rows)
+        return imported
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM known").fetchone()[0]
+
+    def oldest(self, checked_before, after=(-1.0, -1), limit=1000):
+        """ Следующая страница ID, проверенных раньше checked_before, в порядке (checked, id).
+        after — (checked, id) последнего ID прошлой страницы """
+        return self.conn.execute(
+            """
+            SELECT id, username, checked, etag, last_modified FROM known
+            WHERE checked < ? AND (checked > ? OR (checked = ? AND id > ?))
+            ORDER BY checked, id LIMIT ?
+            """,
+            (checked_before, after[0], after[0], after[1], limit),
+        ).fetchall()
+
+    def mark_checked(self, user_id, etag=None, last_modified=None, username=None):
+        """ Отмечает проверку; username — новый ник, если он сменился """
+        self.pending_checks.append((time.time(), etag, last_modified, username, user_id))
+        if len(self.pending_checks) >= COMMIT_EVERY:
+            self.commit()
+
+    def record_rename(self, user_id, old_username, new_username):
+        self.pending_renames.append((user_id, old_username, new_username, time.time()))
+
+    def commit(self):
+        with self.conn:
+            self.conn.executemany(
+                """
+                UPDATE known SET checked = ?, etag = ?, last_modified = ?, username = coalesce(?, username)
+                WHERE id = ?
+                """,
+                self.pending_checks,
+            )
+            self.conn.executemany(
+                "INSERT INTO renames (id, old_username, new_username, changed) VALUES (?, ?, ?, ?)",
+                self.pending_renames,
+            )
+        self.pending_checks = []
+        self.pending_renames = []
+
+    def history(self, user_id):
+        """ Смены ника по ID: список (старый, новый, время) по порядку """
+        return self.conn.execute(
+            "SELECT old_username, new_username, changed FROM renames WHERE id = ? ORDER BY changed", (user_id,)
+        ).fetchall()
+
+    def close(self):
+        self.commit()
+        self.conn.close()
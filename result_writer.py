@@ -0,0 +1,211 @@
+import os
+import time
+import asyncio
+from users_meta import count_records
+
+# Сколько строк записывать за один проход
+WRITE_BATCH_SIZE = 500
+
+# Политика fsync: после стольких записей или через столько миллисекунд после первой несинхронизированной
+FSYNC_EVERY_RECORDS = 200
+FSYNC_INTERVAL_MS = 1000
+
+
+class _Flush:
+    """ Точка flush в очереди: строки после нее в ту же пачку не попадают """
+
+    def __init__(self, path, waiter):
+        self.path = path
+        self.waiter = waiter
+
+
+class _Exclusive:
+    """ Функция, которая выполняется в задаче записи, пока та не держит файлы открытыми """
+
+    def __init__(self, func, args, waiter):
+        self.func = func
+        self.args = args
+        self.waiter = waiter
+
+
+class ResultWriter:
+    """ Отдельная задача записи: воркеры кладут строки в очередь, на диск они уходят пачками.
+    Если передан metrics (см. crawl_metrics.py), в него пишутся время пачек и число строк и fsync """
+
+    def __init__(self, meta_files=(), fsync_every=FSYNC_EVERY_RECORDS, fsync_interval_ms=FSYNC_INTERVAL_MS, metrics=None):
+        self.queue = asyncio.Queue()
+        self.metrics = metrics
+        self.meta_files = set(meta_files)
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval_ms / 1000
+        self.files = {}
+        self.unsynced = 0
+        self.unsynced_since = None
+        self.pending = []
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    def check(self):
+        """ Бросает RuntimeError, если задача записи уже остановилась: строки из очереди никто не запишет """
+        if self.task is None or not self.task.done():
+            return
+        if self.task.cancelled():
+            raise RuntimeError("Задача записи отменена")
+        error = self.task.exception()
+        raise RuntimeError(f"Задача записи упала: {error!r}" if error is not None else "Задача записи остановлена")
+
+    def write(self, path, line):
+        """ Ставит строку в очередь на запись, не блокируя воркер """
+        self.check()
+        self.queue.put_nowait((path, line))
+
+    async def flush(self, path=None):
+        """ Ждет, пока все поставленные до вызова строки окажутся на диске после fsync.
+        Если передан path, возвращает os.stat этого файла ровно в точке flush, до строк,
+        поставленных позже (None, если файла нет) """
+        self.check()
+        waiter = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait(_Flush(path, waiter))
+        return await waiter
+
+    async def exclusive(self, func, *args):
+        """ Записывает и синхронизирует все строки, поставленные до вызова, закрывает файлы
+        и выполняет func(*args) в потоке. Строки, поставленные позже, ждут в очереди,
+        а файлы открываются заново при следующей записи. Возвращает результат func """
+        self.check()
+        waiter = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait(_Exclusive(func, args, waiter))
+        return await waiter
+
+    async def close(self):
+        """ Дописывает очередь, синхронизирует файлы и останавливает задачу """
+        if self.task.done():
+            # Задача уже остановилась: отдаем ее исключение, а не ждем пустую очередь
+            await self.task
+            return
+        self.queue.put_nowait(None)
+        await self.task
+
+    async def run(self):
+        try:
+            await self._run()
+        except BaseException as e:
+            self._fail_pending(e)
+            raise
+
+    def _fail_pending(self, error):
+        """ Будит всех, кто ждет flush/exclusive, чтобы они не зависли после падения задачи """
+        if not isinstance(error, Exception):
+            error = RuntimeError("Задача записи отменена")
+        waiters = self.pending
+        self.pending = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if isinstance(item, (_Flush, _Exclusive)):
+                waiters.append(item)
+        for item in waiters:
+            if not item.waiter.done():
+                item.waiter.set_exception(error)
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            timeout = None
+            if self.unsynced_since is not None:
+                timeout = max(0, self.unsynced_since + self.fsync_interval - time.monotonic())
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                await asyncio.to_thread(self._sync)
+                continue
+
+            batch = []
+            flush = None
+            job = None
+            while item is not None:
+                if isinstance(item, _Exclusive):
+                    job = item
+                    break
+                if isinstance(item, _Flush):
+                    # Пачка заканчивается на flush, чтобы размер файла совпал с точкой вызова
+                    flush = item
+                    break
+                batch.append(item)
+                if len(batch) >= WRITE_BATCH_SIZE or self.queue.empty():
+                    break
+                item = self.queue.get_nowait()
+            stopping = item is None
+            self.pending = [w for w in (flush, job) if w is not None]
+
+            stat = await asyncio.to_thread(
+                self._write_batch, batch, stopping or bool(self.pending), flush and flush.path
+            )
+            if flush is not None and not flush.waiter.done():
+                flush.waiter.set_result(stat)
+            if job is not None:
+                await self._run_exclusive(job)
+            self.pending = []
+        await asyncio.to_thread(self._close_files)
+
+    async def _run_exclusive(self, job):
+        await asyncio.to_thread(self._close_files)
+        try:
+            result = await asyncio.to_thread(job.func, *job.args)
+        except Exception as e:
+            if not job.waiter.done():
+                job.waiter.set_exception(e)
+        else:
+            if not job.waiter.done():
+                job.waiter.set_result(result)
+
+    def _write_batch(self, batch, force_sync, stat_path=None):
+        started = time.perf_counter()
+        grouped = {}
+        for path, line in batch:
+            grouped.setdefault(path, []).append(line)
+        for path, lines in grouped.items():
+            f = self.files.get(path)
+            if f is None:
+                f = self.files[path] = open(path, "a", encoding="utf-8-sig")
+            f.write("".join(lines))
+            f.flush()
+
+        if batch and self.unsynced_since is None:
+            self.unsynced_since = time.monotonic()
+        self.unsynced += len(batch)
+        if (
+            force_sync
+            or self.unsynced >= self.fsync_every
+            or (self.unsynced and time.monotonic() - self.unsynced_since >= self.fsync_interval)
+        ):
+            self._sync()
+        if self.metrics is not None and batch:
+            self.metrics.observe("write_seconds", time.perf_counter() - started)
+            self.metrics.inc("written_lines_total", value=len(batch))
+            self.metrics.inc("write_batches_total")
+        if stat_path is not None and os.path.exists(stat_path):
+            return os.stat(stat_path)
+        return None
+
+    def _sync(self):
+        for path, f in self.files.items():
+            os.fsync(f.fileno())
+            if path in self.meta_files:
+                try:
+                    count_records(path)
+                except Exception as e:
+                    # Метаданные только подсказка для бота: запись строк из-за них останавливать нельзя
+                    print(f"[⚠] Не удалось обновить метаданные {path}: {e}")
+        if self.metrics is not None:
+            self.metrics.inc("fsyncs_total")
+        self.unsynced = 0
+        self.unsynced_since = None
+
+    def _close_files(self):
+        self._sync()
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
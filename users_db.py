@@ -0,0 +1,179 @@
+import os
+import sys
+import sqlite3
+from users_index import USER_URL, iter_line_blocks, parse_user_line, read_renames
+from refresh_store import REFRESH_DB_FILE
+
+# Файл базы пользователей для режима хранения "sqlite"
+USERS_DB_FILE = "users_funpay.db"
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        username TEXT NOT NULL,
+        username_lower TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS users_username_lower ON users (username_lower);
+    CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+        username_lower, content='users', content_rowid='id', tokenize='trigram'
+    );
+    CREATE TABLE IF NOT EXISTS users_meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER
+    );
+    INSERT OR IGNORE INTO users_meta (key, value) VALUES ('count', 0);
+
+    CREATE TRIGGER IF NOT EXISTS users_ai AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts (rowid, username_lower) VALUES (new.id, new.username_lower);
+        UPDATE users_meta SET value = value + 1 WHERE key = 'count';
+    END;
+    CREATE TRIGGER IF NOT EXISTS users_ad AFTER DELETE ON users BEGIN
+        INSERT INTO users_fts (users_fts, rowid, username_lower) VALUES ('delete', old.id, old.username_lower);
+        UPDATE users_meta SET value = value - 1 WHERE key = 'count';
+    END;
+    CREATE TRIGGER IF NOT EXISTS users_au AFTER UPDATE ON users BEGIN
+        INSERT INTO users_fts (users_fts, rowid, username_lower) VALUES ('delete', old.id, old.username_lower);
+        INSERT INTO users_fts (rowid, username_lower) VALUES (new.id, new.username_lower);
+    END;
+"""
+
+# Для подстрок короче триграммы FTS5 не подходит
+MIN_FTS_QUERY = 3
+
+
+def connect(db_path=USERS_DB_FILE):
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def get_meta(conn, key, default=None):
+    row = conn.execute("SELECT value FROM users_meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row is not None else default
+
+
+def set_meta(conn, key, value):
+    conn.execute("INSERT OR REPLACE INTO users_meta (key, value) VALUES (?, ?)", (key, value))
+
+
+def import_users_file(path, db_path=USERS_DB_FILE, renames_path=REFRESH_DB_FILE):
+    """ Переносит строки users_funpay.txt в базу, затем накладывает смены ника из базы --refresh.
+    Повторный запуск дочитывает только новые строки и новые смены ника """
+    conn = connect(db_path)
+    try:
+        stat = os.stat(path)
+        offset = get_meta(conn, "import_offset", 0)
+        if get_meta(conn, "import_inode") != stat.st_ino or stat.st_size < offset:
+            offset = 0
+        # Файл читается заново — смены ника тоже накладываются заново поверх его строк
+        renames_after = get_meta(conn, "renames_rowid", 0) if offset else 0
+
+        # Первичный импорт в пустую базу: построчные триггеры FTS5 заменяем одним rebuild
+        bulk = get_meta(conn, "count", 0) == 0
+        if bulk:
+            conn.execute("DROP TRIGGER users_ai")
+            conn.execute("DROP TRIGGER users_au")
+
+        imported = 0
+        with open(path, "rb") as file:
+            file.seek(offset)
+            for block in iter_line_blocks(file):
+                rows = []
+                for line in block.decode("utf-8", errors="replace").splitlines():
+                    record = parse_user_line(line)
+                    if record is not None:
+                        rows.append((record[0], record[1], record[1].lower()))
+                with conn:
+                    conn.executemany(
+                        """
+                        INSERT INTO users (id, username, username_lower) VALUES (?, ?, ?)
+                        ON CONFLICT (id) DO UPDATE SET
+                            username = excluded.username, username_lower = excluded.username_lower
+                        WHERE username <> excluded.username
+                        """,
+                        rows,
+                    )
+                    offset += len(block)
+                    set_meta(conn, "import_offset", offset)
+                    set_meta(conn, "import_inode", stat.st_ino)
+                imported += len(rows)
+
+        # В users_funpay.txt смен ника нет: --refresh пишет их только в свою базу (см. refresh_store.py)
+        renames = read_renames(renames_path, renames_after)
+        if renames:
+            with conn:
+                conn.executemany(
+                    "UPDATE users SET username = ?, username_lower = ? WHERE id = ? AND username <> ?",
+                    [(username, username.lower(), user_id, username) for _, user_id, username in renames],
+                )
+                set_meta(conn, "renames_rowid", renames[-1][0])
+
+        if bulk:
+            with conn:
+                conn.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+                set_meta(conn, "count", conn.execute("SELECT COUNT(*) FROM users").fetchone()[0])
+            conn.executescript(SCHEMA)
+        return imported
+    finally:
+        conn.close()
+
+
+def _connect_readonly(db_path):
+    return sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+
+
+def search(db_path, nickname, mode):
+    """ Поиск ника в базе, возвращает список (id, ник) в порядке ID """
+    query = nickname.lower()
+    conn = _connect_readonly(db_path)
+    try:
+        if mode == "strict":
+            rows = conn.execute(
+                "SELECT id, username FROM users WHERE username_lower = ? ORDER BY id", (query,)
+            ).fetchall()
+            return rows
+        if len(query) < MIN_FTS_QUERY:
+            rows = conn.execute(
+                "SELECT id, username, username_lower FROM users WHERE instr(username_lower, ?) > 0 ORDER BY id",
+                (query,),
+            )
+        else:
+            rows = conn.execute(
+                """
+                SELECT users.id, users.username, users.username_lower
+                FROM users_fts JOIN users ON users.id = users_fts.rowid
+                WHERE users_fts MATCH ? ORDER BY users.id
+                """,
+                ('"' + query.replace('"', '""') + '"',),
+            )
+        return [(user_id, username) for user_id, username, lowered in rows if query in lowered]
+    finally:
+        conn.close()
+
+
+def count_users(db_path):
+    conn = _connect_readonly(db_path)
+    try:
+        return get_meta(conn, "count", 0)
+    finally:
+        conn.close()
+
+
+def export_users(db_path, path):
+    """ Выгружает базу в текстовый файл формата users_funpay.txt """
+    conn = _connect_readonly(db_path)
+    try:
+        with open(path, "w", encoding="utf-8") as file:
+            for user_id, username in conn.execute("SELECT id, username FROM users ORDER BY id"):
+                file.write(f"{USER_URL.format(user_id)} - {username}\n")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    source = sys.argv[1] if len(sys.argv) > 1 else "users_funpay.txt"
+    target = sys.argv[2] if len(sys.argv) > 2 else USERS_DB_FILE
+    imported = import_users_file(source, target)
+    print(f"[✔] Импортировано {imported} строк из {source} в {target}.")
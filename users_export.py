@@ -0,0 +1,137 @@
+import os
+import gzip
+import json
+import time
+import shutil
+import asyncio
+from users_index import dataset_generation, iter_line_blocks
+
+# Каталог с готовыми сжатыми выгрузками для /users
+EXPORT_DIR = "exports"
+
+# Лимит Telegram на файл от бота — 50 МБ, оставляем запас под буфер компрессора
+EXPORT_PART_LIMIT = 45 * 1024 * 1024
+
+# Сколько секунд выгрузка отдается без пересборки, даже если файл успел дорасти
+EXPORT_MAX_AGE = 600
+
+# Размер блока при сжатии
+EXPORT_CHUNK_SIZE = 1024 * 1024
+
+
+def compress_parts(source_path, target_dir, name):
+    """ Сжимает файл в gzip-части меньше EXPORT_PART_LIMIT, разрезая только по границам строк """
+    parts = []
+    raw = part = None
+    with open(source_path, "rb") as src:
+        for data in iter_line_blocks(src, chunk_size=EXPORT_CHUNK_SIZE, tail=True):
+            if part is None:
+                part_path = os.path.join(target_dir, f"{name}.part{len(parts) + 1}.txt.gz")
+                raw = open(part_path, "wb")
+                part = gzip.GzipFile(filename=f"{name}.part{len(parts) + 1}.txt", mode="wb", fileobj=raw, mtime=0)
+                parts.append(part_path)
+            part.write(data)
+            if raw.tell() >= EXPORT_PART_LIMIT:
+                part.close()
+                raw.close()
+                part = None
+    if part is not None:
+        part.close()
+        raw.close()
+    return parts
+
+
+def build_export(source_path, generation, name, export_dir=EXPORT_DIR, prepare=None):
+    """ Собирает выгрузку для поколения данных. prepare(path) может сначала выгрузить данные в текст """
+    target_dir = os.path.join(export_dir, str(time.time_ns()))
+    temp_dir = target_dir + ".tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+
+    if prepare is not None:
+        text_path = os.path.join(temp_dir, f"{name}.txt")
+        prepare(text_path)
+        parts = compress_parts(text_path, temp_dir, name)
+        os.remove(text_path)
+    else:
+        parts = compress_parts(source_path, temp_dir, name)
+
+    manifest = {
+        "generation": generation,
+        "created": time.time(),
+        "parts": [os.path.basename(part) for part in parts],
+    }
+    with open(os.path.join(temp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+
+    os.replace(temp_dir, target_dir)
+    return load_manifest(target_dir)
+
+
+def load_manifest(export_path):
+    try:
+        with open(os.path.join(export_path, "manifest.json"), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    manifest["generation"] = tuple(tuple(value) if value is not None else None for value in manifest["generation"])
+    manifest["parts"] = [os.path.join(export_path, part) for part in manifest["parts"]]
+    manifest["path"] = export_path
+    return manifest
+
+
+class ExportCache:
+    """ Сжатые части users_funpay.txt, собираемые один раз на поколение данных """
+
+    def __init__(self, name, export_dir=EXPORT_DIR):
+        self.name = name
+        self.export_dir = export_dir
+        self.current = self._load_latest()
+        self.task = None
+
+    def _load_latest(self):
+        if not os.path.isdir(self.export_dir):
+            return None
+        manifests = [
+            load_manifest(os.path.join(self.export_dir, entry))
+            for entry in os.listdir(self.export_dir)
+            if not entry.endswith(".tmp")
+        ]
+        manifests = [manifest for manifest in manifests if manifest is not None]
+        return max(manifests, key=lambda manifest: manifest["created"], default=None)
+
+    def is_fresh(self, generation):
+        if self.current is None:
+            return False
+        return self.current["generation"] == generation or time.time() - self.current["created"] < EXPORT_MAX_AGE
+
+    async def get_parts(self, source_path, generation_paths, prepare=None):
+        """ Возвращает пути к частям, пересобирая выгрузку только для нового поколения данных """
+        generation = dataset_generation(*generation_paths)
+        if self.is_fresh(generation):
+            return self.current["parts"]
+        if self.task is None:
+            self.task = asyncio.create_task(self._rebuild(source_path, generation, prepare))
+        manifest = await asyncio.shield(self.task)
+        return manifest["parts"]
+
+    async def _rebuild(self, source_path, generation, prepare):
+        try:
+            previous = self.current
+            self.current = await asyncio.to_thread(
+                build_export, source_path, generation, self.name, self.export_dir, prepare
+            )
+            await asyncio.to_thread(self._cleanup, previous)
+            return self.current
+        finally:
+            self.task = None
+
+    def _cleanup(self, previous):
+        """ Оставляет текущую и предыдущую выгрузки: предыдущую еще могут отправлять """
+        keep = {self.current["path"]}
+        if previous is not None:
+            keep.add(previous["path"])
+        for entry in os.listdir(self.export_dir):
+            path = os.path.join(self.export_dir, entry)
+            if path not in keep and not entry.endswith(".tmp"):
+                shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,321 @@
+import os
+import asyncio
+import sqlite3
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from id_bitmap import IdBitmap
+
+USER_URL = "https://funpay.com/users/{}/"
+
+# Размер блока при дочитывании файла
+READ_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Длина n-граммы для индекса поиска по совпадению
+NGRAM_SIZE = 3
+
+
+def parse_user_line(line):
+    """ Разбирает строку вида 'https://funpay.com/users/<id>/ - <ник>' в (id, ник) """
+    if " - " not in line:
+        return None
+    url, username = line.strip().lstrip("\ufeff").split(" - ", 1)
+    try:
+        user_id = int(url.rstrip("/").rsplit("/", 1)[-1])
+    except ValueError:
+        return None
+    return user_id, username
+
+
+def iter_line_blocks(file, size=None, chunk_size=READ_CHUNK_SIZE, tail=False):
+    """ Читает бинарный файл с текущей позиции блоками до chunk_size, обрезанными по последнему
+    переводу строки: каждый блок — только целые строки. size — позиция, дальше которой не читать.
+    Недописанная последняя строка отдается последним блоком только при tail=True """
+    position = file.tell()
+    pending = b""
+    while size is None or position < size:
+        chunk = file.read(chunk_size if size is None else min(chunk_size, size - position))
+        if not chunk:
+            break
+        position += len(chunk)
+        data = pending + chunk
+        cut = data.rfind(b"\n") + 1
+        pending = data[cut:]
+        if cut:
+            yield data[:cut]
+    if tail and pending:
+        yield pending
+
+
+def read_renames(db_path, after=0):
+    """ Смены ника из базы режима --refresh (таблица renames, см. refresh_store.py), записанные
+    после rowid after: список (rowid, id, новый ник) по порядку записи """
+    if not os.path.exists(db_path):
+        return []
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            return conn.execute(
+                "SELECT rowid, id, new_username FROM renames WHERE rowid > ? ORDER BY rowid", (after,)
+            ).fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        # База еще не создана до конца или занята — смены подтянутся при следующем запросе
+        return []
+
+
+def dataset_generation(*paths):
+    """ Поколение данных: меняется при дозаписи, перезаписи или замене любого из файлов """
+    generation = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            generation.append(None)
+            continue
+        generation.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+    return tuple(generation)
+
+
+class QueryCache:
+    """ LRU-кэш результатов поиска, сбрасываемый при смене поколения данных """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation):
+        if generation != self.generation:
+            self.entries.clear()
+            self.generation = generation
+        result = self.entries.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key, generation, result):
+        if generation != self.generation:
+            return
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+class UsersIndex:
+    """ Резидентный индекс users_funpay.txt, дочитывающий только новые строки.
+
+    При shards > 1 индексируется только каждая shards-я строка, начиная с shard.
+    Если передан renames_path, поверх файла накладываются смены ника из базы --refresh:
+    строки сменивших ник ID скрываются во всех шардах, а новый ник добавляется записью
+    в шард с номером id % shards.
+
+    На запись хранится одна строка Python — ник в нижнем регистре, он же ключ strict.
+    Исходные ники лежат подряд в UTF-8 (names, границы в starts) и декодируются только для ответа.
+    """
+
+    def __init__(self, path, shard=0, shards=1, renames_path=None):
+        self.path = path
+        self.shard = shard
+        self.shards = shards
+        self.renames_path = renames_path
+        self.generation = 0
+        self._reset()
+
+    def _reset(self):
+        self.ids = array("q")
+        self.names = bytearray()
+        self.starts = array("Q", [0])
+        self.lowered = []
+        # Ник в нижнем регистре -> позиция; array позиций заводится только при совпадении ников
+        self.strict = {}
+        self.trigrams = {}
+        self.renamed = IdBitmap()
+        self.overlay = {}
+        self.renames_after = 0
+        self.offset = 0
+        self.line_no = 0
+        self.inode = None
+        self.mtime_ns = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def refresh(self):
+        """ Подтягивает изменения файла. Возвращает True, если индекс изменился """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            if self.inode is not None:
+                self._reset()
+                self.generation += 1
+                return True
+            return False
+
+        rewritten = (
+            stat.st_ino != self.inode
+            or stat.st_size < self.offset
+            or (stat.st_size == self.offset and stat.st_mtime_ns != self.mtime_ns)
+        )
+        if rewritten:
+            # Файл заменен или перезаписан чекером — строим индекс заново
+            self._reset()
+
+        changed = rewritten
+        if stat.st_size > self.offset:
+            changed = self._load_tail(stat.st_size) or changed
+        if self.renames_path is not None:
+            changed = self._load_renames() or changed
+
+        self.inode = stat.st_ino
+        self.mtime_ns = stat.st_mtime_ns
+        if changed:
+            self.generation += 1
+        return changed
+
+    def _load_tail(self, size):
+        """ Читает байты с последнего смещения до size, учитывая только целые строки """
+        added = False
+        with open(self.path, "rb") as file:
+            file.seek(self.offset)
+            for block in iter_line_blocks(file, size):
+                self._add_lines(block.decode("utf-8", errors="replace"))
+                self.offset += len(block)
+                added = True
+        return added
+
+    def _add_lines(self, text):
+        for line in text.splitlines():
+            line_no = self.line_no
+            self.line_no += 1
+            if line_no % self.shards != self.shard:
+                continue
+            record = parse_user_line(line)
+            if record is not None:
+                self._add_record(*record)
+
+    def _add_record(self, user_id, username):
+        lowered = username.lower()
+        position = len(self.ids)
+        self.ids.append(user_id)
+        self.names += username.encode("utf-8")
+        self.starts.append(len(self.names))
+        self.lowered.append(lowered)
+        found = self.strict.get(lowered)
+        if found is None:
+            self.strict[lowered] = position
+        elif isinstance(found, int):
+            self.strict[lowered] = array("I", (found, position))
+        else:
+            found.append(position)
+        for gram in {lowered[i:i + NGRAM_SIZE] for i in range(len(lowered) - NGRAM_SIZE + 1)}:
+            postings = self.trigrams.get(gram)
+            if postings is None:
+                postings = self.trigrams[gram] = array("I")
+            postings.append(position)
+        return position
+
+    def _load_renames(self):
+        """ Дочитывает новые смены ника. Возвращает True, если они были """
+        rows = read_renames(self.renames_path, self.renames_after)
+        for rowid, user_id, username in rows:
+            self.renamed.add(user_id)
+            if user_id % self.shards == self.shard:
+                self.overlay[user_id] = self._add_record(user_id, username)
+            self.renames_after = rowid
+        return bool(rows)
+
+    def search(self, nickname, mode):
+        """ Ищет ник в режиме 'strict' или 'match', возвращает список (id, ник) """
+        query = nickname.lower()
+        if mode == "strict":
+            found = self.strict.get(query, ())
+            positions = (found,) if isinstance(found, int) else found
+        elif len(query) < NGRAM_SIZE:
+            positions = [i for i, name in enumerate(self.lowered) if query in name]
+        else:
+            positions = [i for i in self._candidates(query) if query in self.lowered[i]]
+        # У сменившего ник ID действует только последняя запись из overlay
+        ids, renamed, overlay = self.ids, self.renamed, self.overlay
+        return [
+            (ids[i], self.name(i)) for i in positions
+            if ids[i] not in renamed or overlay.get(ids[i]) == i
+        ]
+
+    def name(self, position):
+        return self.names[self.starts[position]:self.starts[position + 1]].decode("utf-8")
+
+    def _candidates(self, query):
+        """ Кратчайший список позиций среди n-грамм запроса """
+        shortest = None
+        for i in range(len(query) - NGRAM_SIZE + 1):
+            postings = self.trigrams.get(query[i:i + NGRAM_SIZE])
+            if postings is None:
+                return ()
+            if shortest is None or len(postings) < len(shortest):
+                shortest = postings
+        return shortest
+
+
+_shard_index = None
+
+
+def _init_shard(path, shard, shards, renames_path):
+    global _shard_index
+    _shard_index = UsersIndex(path, shard, shards, renames_path)
+
+
+def _search_shard(nickname, mode):
+    _shard_index.refresh()
+    return _shard_index.search(nickname, mode)
+
+
+class SearchEngine:
+    """ Поиск по индексу, разбитому на шарды по отдельным процессам.
+    Если процесс шарда умер, его пул пересоздается, а запрос завершается BrokenProcessPool """
+
+    def __init__(self, path, workers, renames_path=None):
+        self.path = path
+        self.renames_path = renames_path
+        self.executors = [self._start(shard, workers) for shard in range(workers)]
+
+    def _start(self, shard, shards):
+        return ProcessPoolExecutor(max_workers=1, initializer=_init_shard, initargs=(self.path, shard, shards, self.renames_path))
+
+    async def search(self, nickname, mode):
+        parts = await asyncio.gather(*(
+            self._search_shard(shard, nickname, mode) for shard in range(len(self.executors))
+        ))
+        return sorted(record for part in parts for record in part)
+
+    async def _search_shard(self, shard, nickname, mode):
+        executor = self.executors[shard]
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, _search_shard, nickname, mode)
+        except BrokenProcessPool:
+            # Пул пересоздает только первый запрос, заставший его сломанным; индекс шарда загрузится заново
+            if self.executors[shard] is executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.executors[shard] = self._start(shard, len(self.executors))
+            raise
+
+    async def warmup(self):
+        """ Запускает процессы и загружает шарды до первого запроса """
+        await self.search("", "strict")
+
+    async def pids(self):
+        """ PID процессов шардов: каждый процесс сам сообщает свой os.getpid() """
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*(loop.run_in_executor(executor, os.getpid) for executor in self.executors))
+
+    def shutdown(self):
+        for executor in self.executors:
+            executor.shutdown(cancel_futures=True)
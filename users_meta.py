@@ -0,0 +1,78 @@
+import os
+import json
+import tempfile
+
+# Метаданные хранятся рядом с файлом: users_funpay.txt.meta
+META_SUFFIX = ".meta"
+
+# Размер блока при подсчете строк
+COUNT_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def meta_path(path):
+    return path + META_SUFFIX
+
+
+def read_meta(path):
+    try:
+        with open(meta_path(path), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_meta(path, count, offset, inode):
+    """ Атомарно сохраняет число строк до смещения offset в файле с данным inode.
+    Временный файл у каждого вызова свой: метаданные обновляют несколько процессов сразу """
+    target = meta_path(path)
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(target) + ".", suffix=".tmp", dir=os.path.dirname(target) or ".")
+    try:
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump({"count": count, "offset": offset, "inode": inode}, f)
+        os.replace(temp_path, target)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def count_tail(path, offset):
+    """ Считает строки после offset. Возвращает (целых строк, смещение после последней, размер) """
+    lines = 0
+    last_line_end = offset
+    with open(path, "rb") as f:
+        f.seek(offset)
+        position = offset
+        while True:
+            chunk = f.read(COUNT_CHUNK_SIZE)
+            if not chunk:
+                break
+            newlines = chunk.count(b"\n")
+            if newlines:
+                lines += newlines
+                last_line_end = position + chunk.rfind(b"\n") + 1
+            position += len(chunk)
+    return lines, last_line_end, position
+
+
+def count_records(path, save=True):
+    """ Число строк в файле: берется из метаданных, досчитываются только новые байты.
+    save=False — только читать метаданные, не обновляя их (например, из бота) """
+    stat = os.stat(path)
+    meta = read_meta(path)
+    if meta is None or meta.get("inode") != stat.st_ino or meta.get("offset", 0) > stat.st_size:
+        count, offset = 0, 0
+    else:
+        count, offset = meta["count"], meta["offset"]
+
+    if offset == stat.st_size:
+        return count
+
+    lines, offset, size = count_tail(path, offset)
+    count += lines
+    if save:
+        write_meta(path, count, offset, stat.st_ino)
+    # Недописанная последняя строка тоже считается, но в метаданные не попадает
+    return count + (1 if size > offset else 0)